@@ -0,0 +1,62 @@
+import time
+
+
+class AdaptiveRate(object):
+    """Adapt the period of a poll job to the dynamics of its key fields.
+    When one of the key fields changes faster than rateThreshold (per sec)
+    the job is polled every minPeriod. When the values are stable the period
+    grows with growFactor per poll, up to maxPeriod. The period is never
+    shorter than the bus time budget allows: busBudget is the max fraction of
+    the bus time for all jobs of the bus together.
+    """
+
+    def __init__(self, scheduler, job, blockName, keyFields, rateThreshold, minPeriod, maxPeriod, busBudget, growFactor=1.25):
+        self.scheduler = scheduler
+        self.job = job
+        self.blockName = blockName
+        self.keyFields = keyFields
+        self.rateThreshold = rateThreshold
+        self.minPeriod = minPeriod
+        self.maxPeriod = maxPeriod
+        self.busBudget = busBudget
+        self.growFactor = growFactor
+        self.lastValues = None
+        self.lastTime = None
+        self.fastPolls = 0
+
+    def budgetPeriod(self):
+        # Shortest period which keeps the load of all jobs within the budget
+        otherLoad = self.scheduler.busLoad() - self.job.busTime / self.job.period
+        spare = self.busBudget - otherLoad
+        if spare <= 0:
+            return self.maxPeriod
+        return min(self.maxPeriod, self.job.busTime / spare)
+
+    def update(self, blockData, now=None):
+        # Called with the data of the block, after each poll
+        if now is None:
+            now = time.monotonic()
+        values = [blockData.get(name) for name in self.keyFields]
+        if (self.lastValues is None) or (None in values) or (None in self.lastValues) or (now <= self.lastTime):
+            self.lastValues = values
+            self.lastTime = now
+            return
+
+        rate = max(abs(value - lastValue) for value, lastValue in zip(values, self.lastValues)) / (now - self.lastTime)
+        self.lastValues = values
+        self.lastTime = now
+
+        if rate > self.rateThreshold:
+            self.fastPolls += 1
+            period = self.minPeriod
+        else:
+            period = min(self.job.period * self.growFactor, self.maxPeriod)
+        period = max(period, self.budgetPeriod())
+        if period != self.job.period:
+            self.scheduler.setPeriod(self.job, period, now)
+
+    def getStats(self):
+        return {
+            'period': round(self.job.period, 2),
+            'fastPolls': self.fastPolls,
+        }
@@ -0,0 +1,186 @@
+import time
+import asyncio
+from collections import deque
+
+# Request priorities, a lower value is sent first
+PRIORITY_CONTROL = 0  # Control/dispatch writes
+PRIORITY_ON_DEMAND = 1  # Reads asked for via MQTT, read-back after a write
+PRIORITY_POLL = 2  # Periodic polls
+PRIORITY_NAMES = ('control', 'onDemand', 'poll')
+
+
+class WaitStats(object):
+    """Time the requests of one priority are waiting in the queue."""
+
+    def __init__(self):
+        self.count = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+
+    def add(self, waitTime):
+        self.count += 1
+        self.totalWait += waitTime
+        self.maxWait = max(self.maxWait, waitTime)
+
+    def getStats(self):
+        return {
+            'count': self.count,
+            'avgWait': round(self.totalWait / self.count, 4) if self.count else 0.0,
+            'maxWait': round(self.maxWait, 4),
+        }
+
+
+class Transaction(object):
+    """One send of a request, handed to the bus by BusArbiter.get(). The read
+    requests are shared by all the polls (see modbusMaster.getReadRequest())
+    and can be queued again while they are in flight, so the state of the
+    send is kept here.
+    """
+
+    def __init__(self, request, waiters):
+        self.request = request
+        self.waiters = waiters  # Futures of waitDone(), for the callers which queued the request before this send
+        self.sendTime = None
+        self.exceptionCode = None  # Of the response, None when it was OK
+
+
+class BusArbiter(object):
+    """Share one bus fairly between the devices on it. Control writes go
+    first, then the on-demand reads, then the polls. Within a priority each
+    device has its own request queue and the queues are served round-robin,
+    so a device with many (or slow) requests can't starve the others.
+
+    The queue is bounded: a request which is still waiting is not queued
+    again (coalesced), above highWater the scheduler has to skip the polls
+    (backpressure) and at maxDepth a new poll is dropped. A control or
+    on-demand request replaces the oldest waiting poll then.
+    """
+
+    def __init__(self, devices, maxDepth, highWater, healthChanged=None):
+        self.devices = {device.address: device for device in devices}
+        # Per priority: {address: deque((request, queueTime))} and the round-robin order
+        self.queues = [{device.address: deque() for device in devices} for _ in PRIORITY_NAMES]
+        self.orders = [deque(self.devices.keys()) for _ in PRIORITY_NAMES]
+        self.waitStats = [WaitStats() for _ in PRIORITY_NAMES]
+        self.notEmpty = asyncio.Event()
+        self.healthChanged = healthChanged
+        self.maxDepth = maxDepth
+        self.highWater = highWater
+        self.waiters = {}  # request: [futures] of the queued requests, see waitDone()
+        self.nrQueued = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.deferred = 0
+
+    def put(self, request, priority=PRIORITY_POLL, waiters=()):
+        """Queue the request, waiters: futures of waitDone() to pass to its
+        next send (like for a retry).
+        Returns:
+            False when the request is dropped (queue full), True when it is
+            queued or the same request is still waiting.
+        """
+        queue = self.queues[priority][request.slaveAddr]
+        if any(queuedRequest is request for queuedRequest, _ in queue):
+            self.coalesced += 1
+            self.waiters.setdefault(request, []).extend(waiters)
+            return True
+
+        if self.nrQueued >= self.maxDepth:
+            if (priority == PRIORITY_POLL) or not self.dropOldestPoll():
+                print("Transmit queue full, request %s dropped" % request)
+                self.dropped += 1
+                return False
+
+        queue.append((request, time.monotonic()))
+        if waiters:
+            self.waiters.setdefault(request, []).extend(waiters)
+        self.nrQueued += 1
+        self.notEmpty.set()
+        return True
+
+    def dropOldestPoll(self):
+        # Make room for a request with a higher priority
+        oldestQueue = None
+        for queue in self.queues[PRIORITY_POLL].values():
+            if queue and ((oldestQueue is None) or (queue[0][1] < oldestQueue[0][1])):
+                oldestQueue = queue
+        if oldestQueue is None:
+            return False
+        request, _ = oldestQueue.popleft()
+        self.nrQueued -= 1
+        self.resolveWaiters(self.waiters.pop(request, ()), None)
+        self.dropped += 1
+        return True
+
+    def pollAllowed(self):
+        # Backpressure: the bus can't keep up, the scheduler skips the polls until the queue is drained
+        if self.nrQueued >= self.highWater:
+            self.deferred += 1
+            return False
+        return True
+
+    def getNowait(self):
+        # Returns the Transaction of the next request, or None when all queues are empty
+        for priority, order in enumerate(self.orders):
+            queues = self.queues[priority]
+            for _ in range(len(order)):
+                address = order[0]
+                order.rotate(-1)
+                queue = queues[address]
+                if queue:
+                    request, queueTime = queue.popleft()
+                    self.nrQueued -= 1
+                    self.waitStats[priority].add(time.monotonic() - queueTime)
+                    return Transaction(request, self.waiters.pop(request, []))
+        return None
+
+    async def get(self):
+        while True:
+            transaction = self.getNowait()
+            if transaction is not None:
+                return transaction
+            self.notEmpty.clear()
+            await self.notEmpty.wait()
+
+    def waitDone(self, request):
+        # Call after put(). Returns a future for the next send of the queued request: set to its
+        # Transaction when the request is answered, None on a timeout or when it is dropped
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(request, []).append(future)
+        return future
+
+    def resolveWaiters(self, waiters, transaction):
+        for future in waiters:
+            if not future.done():
+                future.set_result(transaction)
+
+    def requestDone(self, transaction, responded):
+        # Called by the bus when the request is answered (or the response timeout is expired)
+        self.resolveWaiters(transaction.waiters, transaction if responded else None)
+        device = self.devices.get(transaction.request.slaveAddr)
+        if (device is None) or not device.requestDone(responded, time.monotonic()):
+            return
+        if not device.online:
+            # Don't spend bus time on the polls which are still waiting
+            queue = self.queues[PRIORITY_POLL][device.address]
+            self.nrQueued -= len(queue)
+            for request, _ in queue:
+                self.resolveWaiters(self.waiters.pop(request, ()), None)
+            queue.clear()
+        if self.healthChanged is not None:
+            self.healthChanged(device)
+
+    def depth(self):
+        return self.nrQueued
+
+    def getStats(self):
+        return {
+            'queueDepth': self.nrQueued,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'deferred': self.deferred,
+            'queueWait': self.getWaitStats(),
+        }
+
+    def getWaitStats(self):
+        return {name: waitStats.getStats() for name, waitStats in zip(PRIORITY_NAMES, self.waitStats)}
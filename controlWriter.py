@@ -0,0 +1,158 @@
+import time
+import asyncio
+
+# external files/classes
+import settings
+import registerMap
+import modbusMaster
+import busArbiter
+import readPlanner
+
+
+def buildWriteRequests(slaveAddr, fields, values):
+    # One request per range of adjacent registers: 0x06 for one register, otherwise 0x10
+    requests = []
+    start = None
+    registers = []
+    names = []
+    for field in sorted(fields, key=lambda f: f.address):
+        if (start is not None) and (field.address != start + len(registers)):
+            requests.append(modbusMaster.WriteRequest(slaveAddr, start, registers, '+'.join(names)))
+            start = None
+        if start is None:
+            start = field.address
+            registers = []
+            names = []
+        registers += registerMap.encodeValue(field, values[field.name])
+        names.append(field.name)
+    if start is not None:
+        requests.append(modbusMaster.WriteRequest(slaveAddr, start, registers, '+'.join(names)))
+    return requests
+
+
+class ControlWriter(object):
+    """Write the setpoints received via MQTT to one device. The writes go
+    before all other requests on the bus (PRIORITY_CONTROL), then the
+    control block is read back to confirm the written values. Setpoints
+    received within minInterval after the last write are merged: per field
+    only the last value is written (last write wins). The result is passed
+    to publishAck(device, ack) and to the functions in ackListeners.
+    """
+
+    def __init__(self, bus, device, block, minInterval, publishAck):
+        self.bus = bus
+        self.device = device
+        self.block = block
+        self.minInterval = minInterval
+        self.publishAck = publishAck
+        self.ackListeners = []  # Called with the ack of every write, like the zero export controller
+        # The whole block in one read
+        self.readBack = readPlanner.planReads([(block, block.fields)], block.count)
+        self.pending = {}  # field name: value, not written yet
+        self.lastReceiveTime = None  # Of the last pending setpoint, for the latency
+        self.wakeup = asyncio.Event()
+        self.lastWriteTime = 0.0
+        self.writes = 0
+        self.merged = 0
+        self.failed = 0
+        self.totalLatency = 0.0
+        self.maxLatency = 0.0
+
+    def setpoints(self, values, receiveTime):
+        """Queue the setpoints {field name: value}.
+        Raises:
+            ValueError when a field is unknown, read only or out of its limits,
+            then none of the values is written.
+        """
+        if not isinstance(values, dict) or not values:
+            raise ValueError("Expected a JSON object with {field name: value}")
+        for name, value in values.items():
+            field = self.block.getField(name)
+            if field is None:
+                raise ValueError("Unknown field %s" % name)
+            registerMap.encodeValue(field, value)
+
+        self.merged += len(set(values) & set(self.pending))
+        self.pending.update(values)
+        self.lastReceiveTime = receiveTime
+        self.wakeup.set()
+
+    async def waitDone(self, request, priority):
+        # Returns None when the request is done, otherwise the error
+        if not self.bus.arbiter.put(request, priority):
+            return "transmit queue full"
+        try:
+            # All the queued requests can time out before this one is sent
+            transaction = await asyncio.wait_for(self.bus.arbiter.waitDone(request), settings.RESPONSE_TIMEOUT * (settings.TX_QUEUE_SIZE + 1))
+        except asyncio.TimeoutError:
+            transaction = None
+        if transaction is None:
+            return "no response"
+        if transaction.exceptionCode is not None:
+            return "Modbus exception %02Xh (%s)" % (transaction.exceptionCode, modbusMaster.EXCEPTION_CODES.get(transaction.exceptionCode, 'Unknown'))
+        return None
+
+    async def write(self, values, receiveTime):
+        fields = [self.block.getField(name) for name in values]
+        ack = {'setpoints': values}
+        startTime = time.monotonic()
+        for request in buildWriteRequests(self.device.address, fields, values):
+            error = await self.waitDone(request, busArbiter.PRIORITY_CONTROL)
+            if error is not None:
+                ack['error'] = "%s: %s" % (request.name, error)
+                ack['confirmed'] = False
+                self.failed += 1
+                return ack
+
+        now = time.monotonic()
+        latency = now - receiveTime
+        self.writes += 1
+        self.totalLatency += latency
+        self.maxLatency = max(self.maxLatency, latency)
+        ack['latency'] = round(latency, 3)  # [sec] Last MQTT msg received until the write is acknowledged, incl. the rate limit
+        ack['writeTime'] = round(now - startTime, 3)  # [sec] Only the write(s) on the bus
+
+        # Read-back: processResponse() puts the data in device.lastData (and publishes it)
+        for request in self.readBack:
+            error = await self.waitDone(modbusMaster.getReadRequest(self.device.address, request), busArbiter.PRIORITY_ON_DEMAND)
+            if error is not None:
+                ack['error'] = "read-back: %s" % error
+                ack['confirmed'] = False
+                return ack
+        readValues = self.device.lastData.get(self.block.name, {})
+        # Within half a bit of the register
+        mismatches = {field.name: readValues.get(field.name) for field in fields
+                      if (readValues.get(field.name) is None) or (abs(readValues[field.name] - values[field.name]) > 0.5 / field.scale)}
+        ack['confirmed'] = not mismatches
+        if mismatches:
+            ack['readBack'] = mismatches
+            self.failed += 1
+        return ack
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            # Rate limit: the setpoints received in the meantime are merged
+            delay = self.lastWriteTime + self.minInterval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            values, self.pending = self.pending, {}
+            receiveTime = self.lastReceiveTime
+            if not values:
+                continue
+            self.lastWriteTime = time.monotonic()
+            ack = await self.write(values, receiveTime)
+            print("Control %s: %s" % (self.device.name, ack))
+            self.publishAck(self.device, ack)
+            for listener in self.ackListeners:
+                listener(ack)
+
+    def getStats(self):
+        return {
+            'writes': self.writes,
+            'merged': self.merged,
+            'failed': self.failed,
+            'avgLatency': round(self.totalLatency / self.writes, 4) if self.writes else 0.0,
+            'maxLatency': round(self.maxLatency, 4),
+        }
@@ -524,35 +524,87 @@ def _pack(formatstring, value):
     return result
 
 
-def calculateCRC(inputstring):
+def calculateCRC16(data, register=0xFFFF):
+    """Calculate CRC-16 for Modbus, fast path without argument checks.
+    Args:
+        data (bytes, bytearray or memoryview): An arbitrary-length message.
+        register (int): CRC register to continue from, default preloaded with ones.
+    Returns:
+        The CRC as int. Over a complete frame (including its CRC) it is 0.
+    """
+    table = CRC16TABLE
+
+    for byte in data:
+        register = (register >> 8) ^ table[(register ^ byte) & 0xFF]
+
+    return register
+
+
+def calculateCRCBytes(data):
     """Calculate CRC-16 for Modbus.
     Args:
-        inputstring (str): An arbitrary-length message (without the CRC).
+        data (bytes, bytearray or memoryview): An arbitrary-length message (without the CRC).
     Returns:
-        A two-byte CRC string, where the least significant byte is first.
+        The two raw CRC bytes, where the least significant byte is first.
     """
-    _check_string(inputstring, description="input CRC string")
+    return calculateCRC16(data).to_bytes(2, "little")
 
-    # Preload a 16-bit register with ones
-    register = 0xFFFF
 
-    for char in inputstring:
-        register = (register >> 8) ^ CRC16TABLE[(register ^ ord(char)) & 0xFF]
+def checkFrameCRC(frame):
+    """Check the CRC of a received frame in place (no copies or slices).
+    Args:
+        frame (bytes, bytearray or memoryview): The frame including the two CRC bytes.
+    Returns:
+        True if the CRC is OK.
+    """
+    # The CRC over the message plus its (LSB first) CRC is always 0
+    return (len(frame) > 2) and (calculateCRC16(frame) == 0)
 
-    return numToTwoByteString(register, lsb_first=True)
 
+class CRC16(object):
+    """Incremental CRC-16 for Modbus, to check a frame while the bytes are received.
+    Usage:
+        crc = CRC16()
+        crc.update(chunk1)
+        crc.update(chunk2)
+        crc.digest()  # Two raw CRC bytes, LSB first
+    """
 
-def checkRecvMsgCRC(recvMsg, debug=False):
-    crcStr = recvMsg[-2:]
-    # Convert from bytes to string, without conversion
-    crcStr = "".join([chr(i) for i in crcStr])
+    def __init__(self, data=None):
+        self.register = 0xFFFF
+        if data is not None:
+            self.update(data)
 
-    recvMsgWithoutCRC = recvMsg[0:-2]
-    # Convert from bytes to string, without conversion
-    recvMsgWithoutCRC = "".join([chr(i) for i in recvMsgWithoutCRC])
-    calcCRC = calculateCRC(recvMsgWithoutCRC)
+    def reset(self):
+        # Preload a 16-bit register with ones
+        self.register = 0xFFFF
 
-    if calcCRC == crcStr:
+    def update(self, chunk):
+        self.register = calculateCRC16(chunk, self.register)
+
+    def value(self):
+        return self.register
+
+    def digest(self):
+        return self.register.to_bytes(2, "little")
+
+    def frameOK(self):
+        # True if the CRC bytes of the frame are also passed to update()
+        return self.register == 0
+
+
+def calculateCRC(inputstring):
+    """Calculate CRC-16 for Modbus.
+    Args:
+        inputstring (str): An arbitrary-length message (without the CRC).
+    Returns:
+        A two-byte CRC string, where the least significant byte is first.
+    """
+    return calculateCRCBytes(inputstring.encode("latin1")).decode("latin1")
+
+
+def checkRecvMsgCRC(recvMsg, debug=False):
+    if checkFrameCRC(recvMsg):
         if debug:
             # print("->CRC OK: ", end='')
             print(": ", end='')
@@ -0,0 +1,549 @@
+import time
+import asyncio
+import traceback
+import concurrent.futures
+from collections import deque
+import serial
+import serial.rs485
+
+# external files/classes
+import settings
+import serviceReport
+import rtuFramer
+import modbusMaster
+import modbusTcp
+import busArbiter
+
+
+class ReconnectBackoff(object):
+    """Delay before the next (re)connect, doubles on every attempt up to
+    RECONNECT_DELAY_MAX. It is kept over the connections: only reset() (when
+    the connection has really worked) starts with RECONNECT_DELAY_MIN again,
+    so a server which accepts and then closes the connection isn't hammered.
+    """
+
+    def __init__(self):
+        self.delay = settings.RECONNECT_DELAY_MIN
+
+    def reset(self):
+        self.delay = settings.RECONNECT_DELAY_MIN
+
+    async def wait(self):
+        delay = self.delay
+        self.delay = min(2 * self.delay, settings.RECONNECT_DELAY_MAX)
+        await asyncio.sleep(delay)
+
+
+async def connectToServer(serverAddress, backoff):
+    # Returns (reader, writer) of the connection, retries until cancelled
+    while True:
+        try:
+            # asyncio sets TCP_NODELAY: a request isn't delayed by Nagle
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*serverAddress), 10)
+            print("Connected to %s:%d" % serverAddress)
+            return reader, writer
+
+        except (OSError, asyncio.TimeoutError) as arg:
+            print("Connect to %s:%d failed: %s, retry in %g sec" % (serverAddress[0], serverAddress[1], str(arg) or 'timeout', backoff.delay))
+            await backoff.wait()
+
+
+async def runUntilFirstException(*coroutines):
+    # Run the coroutines as tasks, when one of them fails the others are cancelled
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class BusUsage(object):
+    """Time the bus is busy with transactions: from the start of the request
+    until the response is received (or the response timeout is expired).
+    The on-wire time is the transmit time of the request and response bytes
+    at the baud rate, the rest of the busy time is turnaround and the answer
+    time of the slave. The utilisation is the busy fraction of the last
+    window seconds.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.transactions = deque()  # (endTime, busyTime) of the last window seconds
+        self.windowBusyTime = 0.0
+        self.startTime = time.monotonic()
+        self.nrTransactions = 0
+        self.busyTime = 0.0
+        self.wireTime = 0.0
+        self.maxBusyTime = 0.0
+
+    def add(self, startTime, endTime, wireTime=0.0):
+        busyTime = endTime - startTime
+        self.transactions.append((endTime, busyTime))
+        self.windowBusyTime += busyTime
+        self.nrTransactions += 1
+        self.busyTime += busyTime
+        self.wireTime += wireTime
+        self.maxBusyTime = max(self.maxBusyTime, busyTime)
+
+    def utilisation(self, now=None):
+        # Busy fraction of the last window seconds
+        if now is None:
+            now = time.monotonic()
+        while self.transactions and (self.transactions[0][0] < now - self.window):
+            self.windowBusyTime -= self.transactions.popleft()[1]
+        period = min(self.window, now - self.startTime)
+        if period <= 0:
+            return 0.0
+        return min(1.0, self.windowBusyTime / period)
+
+    def getStats(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        runTime = max(now - self.startTime, 0.001)
+        return {
+            'utilisation': round(100 * self.utilisation(now), 1),  # [%] Last window
+            'avgUtilisation': round(100 * self.busyTime / runTime, 1),  # [%] Since the start
+            'wireUtilisation': round(100 * self.wireTime / runTime, 1),  # [%] Only the bytes on the wire
+            'transactions': self.nrTransactions,
+            'avgBusyTime': round(self.busyTime / self.nrTransactions, 4) if self.nrTransactions else 0.0,
+            'maxBusyTime': round(self.maxBusyTime, 4),
+        }
+
+
+class RtuBus(object):
+    """Half-duplex Modbus RTU bus: one request at a time. The next request is
+    sent when the response (or an exception) is received, or when the
+    response timeout is expired. The requests are taken from the arbiter
+    (see busArbiter.py), the responses are passed to
+    processResponse(device, request, recvMsg).
+
+    The response timeout is the adaptive timeout of the device for the first
+    byte, when it is received the rest of the frame gets its transmit time.
+    After a timeout the request is retried with the full RESPONSE_TIMEOUT.
+    """
+
+    def __init__(self, name, arbiter, processResponse, baudrate, minFrameGap=None):
+        self.name = name
+        self.arbiter = arbiter
+        self.processResponse = processResponse
+        self.baudrate = baudrate
+        self.framer = rtuFramer.RtuFramer(baudrate, minFrameGap)
+        self.master = modbusMaster.ModbusMaster()
+        self.responseDone = asyncio.Event()
+        self.firstByte = asyncio.Event()
+        self.firstByteTime = None
+        self.retries = 0
+        self.charTime = rtuFramer.charTime(baudrate)
+        self.usage = BusUsage(settings.BUS_USAGE_WINDOW)
+        self.rxBytes = 0  # Received since the last request, for the on-wire time
+
+    def transactionTime(self, read):
+        # Estimated bus time of a read: request (8 bytes), response and the answer time of the slave
+        return (8 + read.msgLen) * self.charTime + settings.SLAVE_RESPONSE_TIME
+
+    def dataReceived(self, recvData):
+        if not self.firstByte.is_set():
+            self.firstByteTime = time.monotonic()
+            self.firstByte.set()
+        # Frames are complete as soon as the last CRC byte is received
+        for recvMsg in self.framer.feed(recvData):
+            self.rxBytes += len(recvMsg)
+            transaction = self.master.responseReceived(recvMsg)
+            if transaction is not None:
+                request = transaction.request
+                try:
+                    self.processResponse(self.arbiter.devices[request.slaveAddr], request, recvMsg)
+                except Exception as arg:
+                    print("Exception in processResponse %s: %s" % (self.name, str(arg)))
+                    traceback.print_exc()
+            if self.master.pending is None:
+                self.responseDone.set()
+
+    async def writeFrame(self, frame):
+        # Returns the time the frame is sent (time.monotonic())
+        raise NotImplementedError
+
+    async def waitResponse(self, request, firstByteTimeout):
+        # Returns True when the response (or an exception) is received
+        try:
+            await asyncio.wait_for(self.firstByte.wait(), firstByteTimeout)
+            # The response is coming in, wait for the rest of the frame
+            await asyncio.wait_for(self.responseDone.wait(), request.responseLen * self.charTime + self.framer.frameGap)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def transaction(self, transaction, device, firstByteTimeout):
+        # Drop a partial frame, the answer to this msg is coming next
+        request = transaction.request
+        self.framer.reset()
+        self.responseDone.clear()
+        self.firstByte.clear()
+        self.rxBytes = 0
+        # Before the write: the response can arrive while writeFrame() is waiting
+        startTime = time.monotonic()
+        self.master.requestSent(transaction, startTime)
+        sentTime = await self.writeFrame(request.frame)
+        responded = await self.waitResponse(request, firstByteTimeout)
+        if responded:
+            device.responseTimeout.add(max(0.0, self.firstByteTime - sentTime))
+        else:
+            self.master.requestTimeout()
+        self.usage.add(startTime, time.monotonic(), (len(request.frame) + self.rxBytes) * self.charTime)
+        return responded
+
+    async def requestLoop(self):
+        while True:
+            transaction = await self.arbiter.get()
+            device = self.arbiter.devices[transaction.request.slaveAddr]
+            responded = await self.transaction(transaction, device, device.responseTimeout.timeout())
+            retries = 0
+            while (not responded) and (retries < settings.RESPONSE_RETRIES) and device.online:
+                # Fast retry: the adaptive timeout can be too short, so this time wait the full
+                # timeout. First let a late response finish (the line is silent for the frame gap)
+                retries += 1
+                self.retries += 1
+                await asyncio.sleep(self.framer.frameGap)
+                responded = await self.transaction(transaction, device, settings.RESPONSE_TIMEOUT)
+            self.arbiter.requestDone(transaction, responded)
+
+    def getResponseTimeouts(self):
+        return {device.name: device.responseTimeout.getStats() for device in self.arbiter.devices.values()}
+
+    def getStats(self):
+        return {
+            'timeouts': self.master.timeouts,
+            'retries': self.retries,
+            'exceptions': self.master.exceptions,
+            'unexpected': self.master.unexpected,
+            'droppedBytes': self.framer.droppedBytes,
+            'responseTimeout': self.getResponseTimeouts(),
+            'usage': self.usage.getStats(),
+            'transmitQueue': self.arbiter.getStats(),
+        }
+
+    def close(self):
+        pass
+
+
+class SerialBus(RtuBus):
+    """Modbus RTU on a local RS485 port, RTS switches the RS485 driver. The
+    serial port is non-blocking and watched by the event loop (add_reader).
+    """
+
+    def __init__(self, name, device, arbiter, processResponse, baudrate):
+        RtuBus.__init__(self, name, arbiter, processResponse, baudrate)
+        self.device = device
+        self.serialPort = None
+        self.kernelRs485 = False
+        # One thread: the frames are sent one by one, in order
+        self.transmitThread = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    def open(self):
+        try:
+            self.serialPort = serial.Serial(port=self.device,  # port='/dev/ttyACM0',
+                                            baudrate=self.baudrate,
+                                            parity=serial.PARITY_NONE,
+                                            stopbits=serial.STOPBITS_ONE,
+                                            bytesize=serial.EIGHTBITS,
+                                            timeout=0)  # 1=1sec 0=non-blocking None=Blocked
+
+            if self.serialPort.isOpen():
+                print(("rflink_mqtt: Successfully connected to serial port %s" % self.device))
+
+            if settings.RS485_TURNAROUND == 'kernel':
+                self.enableKernelRs485()
+            return True
+
+        # Handle other exceptions and print the error
+        except Exception as arg:
+            print("%s" % str(arg))
+
+            # Report failure to Home Logic system check
+            serviceReport.sendFailureToHomeLogic(serviceReport.ACTION_NOTHING, 'Serial port open failure on port %s, wrong port or USB cable missing' % self.device)
+            return False
+
+    def readable(self):
+        try:
+            recvData = self.serialPort.read(self.serialPort.in_waiting or 1)
+            if recvData != b"":
+                self.dataReceived(recvData)
+
+        # Handle other exceptions and print the error
+        except Exception as arg:
+            print("Exception in %s: %s" % (self.name, str(arg)))
+            traceback.print_exc()
+            # Stop reading for a while (USB cable removed?)
+            loop = asyncio.get_running_loop()
+            loop.remove_reader(self.serialPort.fileno())
+            loop.call_later(120, loop.add_reader, self.serialPort.fileno(), self.readable)
+
+    def enableKernelRs485(self):
+        # The driver switches RTS at the real start and end of the transmission
+        try:
+            self.serialPort.rs485_mode = serial.rs485.RS485Settings(rts_level_for_tx=True, rts_level_for_rx=False)
+            self.kernelRs485 = True
+            print("Kernel RS485 mode enabled on %s" % self.device)
+        except (ValueError, OSError, NotImplementedError) as arg:
+            self.serialPort.rs485_mode = None
+            print("Kernel RS485 mode not supported on %s (%s), RTS is switched after tcdrain" % (self.device, str(arg)))
+
+    def transmit(self, frame):
+        # Runs in the transmit thread: tcdrain and the turnaround wait don't block the event loop
+        if self.kernelRs485:
+            self.serialPort.write(frame)
+            self.serialPort.flush()
+            return time.monotonic()
+
+        self.serialPort.setRTS(1)  # Enable RS485 send
+        startTime = time.monotonic()
+        self.serialPort.write(frame)
+        # tcdrain: wait until the OS has sent the frame. USB adapters and UART
+        # FIFOs can still be sending then, so also wait for the transmit time
+        # at the configured baud rate
+        self.serialPort.flush()
+        remaining = startTime + len(frame) * self.charTime - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        self.serialPort.setRTS(0)  # Disable RS485 send
+        return time.monotonic()
+
+    async def writeFrame(self, frame):
+        # The time is taken in the transmit thread: the response can already be received
+        # before this coroutine continues
+        return await asyncio.get_running_loop().run_in_executor(self.transmitThread, self.transmit, frame)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+
+        # Wait a while, the OS is probably testing what kind of device is there
+        # with sending 'ATEE' commands and others
+        await asyncio.sleep(2)
+        self.serialPort.reset_input_buffer()
+        if not self.kernelRs485:
+            self.serialPort.setRTS(0)  # Disable RS485 send
+
+        print("%s started" % self.name)
+        loop.add_reader(self.serialPort.fileno(), self.readable)
+        try:
+            while True:
+                try:
+                    await self.requestLoop()
+
+                # Handle other exceptions and print the error
+                except Exception as arg:
+                    print("Exception in %s: %s" % (self.name, str(arg)))
+                    traceback.print_exc()
+                    await asyncio.sleep(120)
+        finally:
+            loop.remove_reader(self.serialPort.fileno())
+
+    def close(self):
+        # Wait for a frame which is still being sent
+        self.transmitThread.shutdown(wait=True)
+        if self.serialPort is not None:
+            if not self.kernelRs485:
+                self.serialPort.setRTS(0)  # Disable RS485 send
+            self.serialPort.close()
+            print('Closed serial port')
+
+
+class GatewayBus(RtuBus):
+    """Modbus RTU frames via a serial server (like a Moxa NPort) in TCP server mode."""
+
+    def __init__(self, name, gatewayAddress, arbiter, processResponse, baudrate):
+        RtuBus.__init__(self, name, arbiter, processResponse, baudrate, settings.GATEWAY_FRAME_GAP_MIN)
+        self.gatewayAddress = gatewayAddress
+        self.writer = None
+        self.backoff = ReconnectBackoff()
+
+    async def transaction(self, request, device, firstByteTimeout):
+        responded = await RtuBus.transaction(self, request, device, firstByteTimeout)
+        if responded:
+            # The connection works: a next reconnect starts with the min delay
+            self.backoff.reset()
+        return responded
+
+    async def writeFrame(self, frame):
+        # The whole frame in one call, the serial server takes care of the RS485 timing
+        self.writer.write(frame)
+        await self.writer.drain()
+        return time.monotonic()
+
+    async def receiveLoop(self, reader):
+        while True:
+            recvData = await reader.read(4096)
+            if recvData == b"":
+                raise ConnectionError("Connection closed by the serial server")
+            self.dataReceived(recvData)
+
+    async def run(self):
+        print("%s started" % self.name)
+        while True:
+            reader, self.writer = await connectToServer(self.gatewayAddress, self.backoff)
+            self.framer.reset()
+            try:
+                await runUntilFirstException(self.receiveLoop(reader), self.requestLoop())
+
+            # Handle the exceptions and print the error, then reconnect
+            except (OSError, ValueError) as arg:
+                print("Exception in %s: %s, reconnect in %g sec" % (self.name, str(arg), self.backoff.delay))
+
+            finally:
+                self.writer.close()
+            await self.backoff.wait()
+
+
+class TcpBus(object):
+    """Modbus TCP: the requests are pipelined, up to TCP_MAX_IN_FLIGHT
+    requests are waiting for a response at the same time. Each request has
+    its own response timeout timer, with the adaptive timeout of the device.
+    After a timeout the request is queued again (on-demand priority) and
+    then waits the full RESPONSE_TIMEOUT.
+    """
+
+    def __init__(self, name, serverAddress, arbiter, processResponse):
+        self.name = name
+        self.serverAddress = serverAddress
+        self.arbiter = arbiter
+        self.processResponse = processResponse
+        self.framer = modbusTcp.MbapFramer()
+        self.master = modbusTcp.TcpMaster()
+        self.inFlightSlots = asyncio.Semaphore(settings.TCP_MAX_IN_FLIGHT)
+        self.timers = {}  # transactionId: (response timeout timer, busArbiter.Transaction)
+        self.retrying = {}  # request: nr of retries
+        self.backoff = ReconnectBackoff()
+        self.retries = 0
+        # Pipelined: the bus is busy while at least one request is in flight
+        self.usage = BusUsage(settings.BUS_USAGE_WINDOW)
+        self.busySince = None
+
+    def transactionTime(self, read):
+        # Requests are pipelined, the Modbus TCP server behind it has the same answer time
+        return settings.SLAVE_RESPONSE_TIME / settings.TCP_MAX_IN_FLIGHT
+
+    def dataReceived(self, recvData):
+        for transactionId, recvMsg in self.framer.feed(recvData):
+            transaction = self.master.responseReceived(transactionId, recvMsg)
+            self.transactionDone(transactionId)
+            if transaction is not None:
+                request = transaction.request
+                try:
+                    self.processResponse(self.arbiter.devices[request.slaveAddr], request, recvMsg)
+                except Exception as arg:
+                    print("Exception in processResponse %s: %s" % (self.name, str(arg)))
+                    traceback.print_exc()
+
+    def transactionDone(self, transactionId):
+        if transactionId in self.timers:
+            timer, transaction = self.timers.pop(transactionId)
+            request = transaction.request
+            timer.cancel()
+            self.inFlightSlots.release()
+            self.checkIdle()
+            self.retrying.pop(request, None)
+            # The connection works: a next reconnect starts with the min delay
+            self.backoff.reset()
+            # The whole response arrives at once, the latency includes the requests in flight before it
+            self.arbiter.devices[request.slaveAddr].responseTimeout.add(time.monotonic() - transaction.sendTime)
+            self.arbiter.requestDone(transaction, True)
+
+    def transactionTimeout(self, transactionId):
+        _, transaction = self.timers.pop(transactionId)
+        request = transaction.request
+        self.master.requestTimeout(transactionId)
+        self.inFlightSlots.release()
+        self.checkIdle()
+        retries = self.retrying.get(request, 0)
+        if (retries < settings.RESPONSE_RETRIES) and self.arbiter.devices[request.slaveAddr].online:
+            # Fast retry: before the polls which are waiting
+            self.retrying[request] = retries + 1
+            self.retries += 1
+            # The callers waiting for this send wait for the retry
+            if self.arbiter.put(request, busArbiter.PRIORITY_ON_DEMAND, transaction.waiters):
+                return
+        self.retrying.pop(request, None)
+        self.arbiter.requestDone(transaction, False)
+
+    def checkIdle(self):
+        if not self.timers and (self.busySince is not None):
+            self.usage.add(self.busySince, time.monotonic())
+            self.busySince = None
+
+    def resetTransactions(self):
+        # Connection is lost: the requests in flight will never be answered
+        for timer, transaction in self.timers.values():
+            timer.cancel()
+            self.inFlightSlots.release()
+            self.arbiter.resolveWaiters(transaction.waiters, None)
+        self.timers.clear()
+        self.retrying.clear()
+        self.checkIdle()
+        self.master.reset()
+
+    async def receiveLoop(self, reader):
+        while True:
+            recvData = await reader.read(4096)
+            if recvData == b"":
+                raise ConnectionError("Connection closed by the Modbus TCP server")
+            self.dataReceived(recvData)
+
+    async def requestLoop(self, writer):
+        loop = asyncio.get_running_loop()
+        while True:
+            transaction = await self.arbiter.get()
+            request = transaction.request
+            # Pipelining: only wait when the max nr of requests is in flight
+            await self.inFlightSlots.acquire()
+            now = time.monotonic()
+            if self.busySince is None:
+                self.busySince = now
+            frame = self.master.buildFrame(transaction, now)
+            transactionId = self.master.transactionId
+            if request in self.retrying:
+                responseTimeout = settings.RESPONSE_TIMEOUT
+            else:
+                responseTimeout = self.arbiter.devices[request.slaveAddr].responseTimeout.timeout()
+            self.timers[transactionId] = (loop.call_later(responseTimeout, self.transactionTimeout, transactionId), transaction)
+            writer.write(frame)
+            await writer.drain()
+
+    async def run(self):
+        print("%s started" % self.name)
+        while True:
+            # Persistent connection, reconnect when it is lost
+            reader, writer = await connectToServer(self.serverAddress, self.backoff)
+            self.framer.reset()
+            try:
+                await runUntilFirstException(self.receiveLoop(reader), self.requestLoop(writer))
+
+            # Handle the exceptions and print the error, then reconnect
+            except (OSError, ValueError) as arg:
+                print("Exception in %s: %s, reconnect in %g sec" % (self.name, str(arg), self.backoff.delay))
+
+            finally:
+                writer.close()
+                self.resetTransactions()
+            await self.backoff.wait()
+
+    def getResponseTimeouts(self):
+        return {device.name: device.responseTimeout.getStats() for device in self.arbiter.devices.values()}
+
+    def getStats(self):
+        return {
+            'timeouts': self.master.timeouts,
+            'retries': self.retries,
+            'exceptions': self.master.exceptions,
+            'unexpected': self.master.unexpected,
+            'inFlight': len(self.timers),
+            'responseTimeout': self.getResponseTimeouts(),
+            'usage': self.usage.getStats(),
+            'transmitQueue': self.arbiter.getStats(),
+        }
+
+    def close(self):
+        pass
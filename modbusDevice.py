@@ -0,0 +1,126 @@
+import math
+from collections import deque
+
+
+class ResponseTimeout(object):
+    """Response timeout of a device, from a rolling histogram of the measured
+    latencies (end of the request until the first byte of the response).
+    The timeout is the latency percentile times margin, clamped between
+    minTimeout and maxTimeout. Until minSamples latencies are measured the
+    timeout is maxTimeout.
+    """
+
+    def __init__(self, minTimeout, maxTimeout, percentile, margin, window, minSamples, bucketWidth=0.005):
+        self.minTimeout = minTimeout
+        self.maxTimeout = maxTimeout
+        self.percentile = percentile
+        self.margin = margin
+        self.window = window
+        self.minSamples = minSamples
+        self.bucketWidth = bucketWidth
+        self.buckets = [0] * (int(maxTimeout / bucketWidth) + 1)  # Nr of latencies per bucket
+        self.samples = deque()  # Bucket index of the last window latencies, oldest first
+        self.current = maxTimeout
+        self.maxLatency = 0.0
+
+    def add(self, latency):
+        bucket = min(int(latency / self.bucketWidth), len(self.buckets) - 1)
+        self.buckets[bucket] += 1
+        self.samples.append(bucket)
+        if len(self.samples) > self.window:
+            self.buckets[self.samples.popleft()] -= 1
+        self.maxLatency = max(self.maxLatency, latency)
+        if len(self.samples) >= self.minSamples:
+            self.current = min(max(self.latency(self.percentile) * self.margin, self.minTimeout), self.maxTimeout)
+
+    def latency(self, percentile):
+        # Upper edge of the bucket with the percentile, 0.0 without samples
+        target = math.ceil(percentile * len(self.samples))
+        count = 0
+        for bucket, bucketCount in enumerate(self.buckets):
+            count += bucketCount
+            if (count >= target) and (count > 0):
+                return (bucket + 1) * self.bucketWidth
+        return 0.0
+
+    def timeout(self):
+        return self.current
+
+    def getStats(self):
+        return {
+            'timeout': round(self.current, 3),
+            'p50': round(self.latency(0.5), 3),
+            'p99': round(self.latency(0.99), 3),
+            'maxLatency': round(self.maxLatency, 3),
+            'samples': len(self.samples),
+        }
+
+
+class Device(object):
+    """A Modbus slave on a bus: slave address, register blocks, topic prefix
+    and health. After offlineAfter consecutive requests without a response the
+    device is offline, then only one request per probeInterval is sent, so a
+    dead slave doesn't take the bus time of the others.
+    """
+
+    def __init__(self, name, address, blocks, topicPrefix, offlineAfter, probeInterval, responseTimeout):
+        self.name = name
+        self.address = address
+        self.blocks = {block.name: block for block in blocks}
+        self.topicPrefix = topicPrefix
+        self.offlineAfter = offlineAfter
+        self.probeInterval = probeInterval
+        self.responseTimeout = responseTimeout  # ResponseTimeout
+        self.online = True
+        self.failures = 0  # Consecutive requests without response
+        self.responses = 0
+        self.timeouts = 0
+        self.lastProbeTime = 0.0
+        self.lastData = {}  # block name: last received data
+        self.polledFields = {}  # block name: names of the fields in the poll plans
+
+    def isComplete(self, blockName):
+        # All the polled fields of the block are received, at least once
+        return self.polledFields.get(blockName, set()).issubset(self.lastData.get(blockName, {}))
+
+    def topic(self, subTopic):
+        return self.topicPrefix + '/' + subTopic
+
+    def mayPoll(self, now):
+        if self.online:
+            return True
+        if (now - self.lastProbeTime) >= self.probeInterval:
+            self.lastProbeTime = now
+            return True
+        return False
+
+    def requestDone(self, responded, now):
+        """Update the health with the result of a request.
+        Returns:
+            True when the device went online or offline.
+        """
+        if responded:
+            self.responses += 1
+            self.failures = 0
+            if not self.online:
+                print("Modbus device %s (%02Xh) is online again" % (self.name, self.address))
+                self.online = True
+                return True
+            return False
+
+        self.timeouts += 1
+        self.failures += 1
+        if self.online and (self.failures >= self.offlineAfter):
+            print("Modbus device %s (%02Xh) is offline, probe every %d sec" % (self.name, self.address, self.probeInterval))
+            self.online = False
+            self.lastProbeTime = now
+            return True
+        return False
+
+    def getHealth(self):
+        return {
+            'online': self.online,
+            'responses': self.responses,
+            'timeouts': self.timeouts,
+            'failures': self.failures,
+        }
@@ -0,0 +1,181 @@
+import struct
+
+# external files/classes
+import modbus
+
+READ_HOLDING_REGISTERS = 0x03
+WRITE_SINGLE_REGISTER = 0x06
+WRITE_MULTIPLE_REGISTERS = 0x10
+
+EXCEPTION_CODES = {
+    0x01: 'Illegal function',
+    0x02: 'Illegal data address',
+    0x03: 'Illegal data value',
+    0x04: 'Slave device failure',
+    0x05: 'Acknowledge',
+    0x06: 'Slave device busy',
+}
+
+# Results of ModbusMaster.checkResponse()
+RESPONSE_OK = 0
+RESPONSE_EXCEPTION = 1
+RESPONSE_MISMATCH = 2
+
+# Ready to write request PDUs (function code and data), key: (function, start, count)
+requestPduCache = {}
+
+# Ready to write request frames, key: (slaveAddr, function, start, count)
+requestFrameCache = {}
+
+# Request objects which are reused for every poll, key: (slaveAddr, read). The key is the
+# planned read object itself: a new poll plan has new objects, so it never gets a stale request
+readRequestCache = {}
+
+
+def getRequestPdu(function, start, count):
+    key = (function, start, count)
+    pdu = requestPduCache.get(key)
+    if pdu is None:
+        pdu = struct.pack('>BHH', function, start, count)
+        requestPduCache[key] = pdu
+    return pdu
+
+
+def getRequestFrame(slaveAddr, function, start, count):
+    # Modbus RTU frame: modBusAddr, PDU, CRC
+    key = (slaveAddr, function, start, count)
+    frame = requestFrameCache.get(key)
+    if frame is None:
+        msg = bytes([slaveAddr]) + getRequestPdu(function, start, count)
+        frame = msg + modbus.calculateCRCBytes(msg)
+        requestFrameCache[key] = frame
+    return frame
+
+
+def getReadRequest(slaveAddr, block):
+    # Build the request only the first time, after that it costs a dict lookup
+    key = (slaveAddr, block)
+    request = readRequestCache.get(key)
+    if request is None:
+        request = ReadRequest(slaveAddr, block)
+        readRequestCache[key] = request
+    return request
+
+
+class ReadRequest(object):
+    """Read holding registers (0x03) of a planned read (see readPlanner.py).
+    The response is matched to the request, then decoded with block.decode().
+    """
+    function = READ_HOLDING_REGISTERS
+
+    def __init__(self, slaveAddr, block):
+        self.slaveAddr = slaveAddr
+        self.block = block
+        self.start = block.start
+        self.count = block.count
+        self.pdu = getRequestPdu(self.function, self.start, self.count)
+        self.frame = getRequestFrame(slaveAddr, self.function, self.start, self.count)
+        # Response: modBusAddr, function, byte count, data, CRC
+        self.responseLen = 5 + 2 * self.count
+
+    def __str__(self):
+        return "%s (slave %02Xh, function %02Xh, start %04Xh, count %d)" % (self.block.name, self.slaveAddr, self.function, self.start, self.count)
+
+    def isResponse(self, recvMsg):
+        # modBusAddr, function and byte count must match the request
+        return (recvMsg[0] == self.slaveAddr) and (recvMsg[1] == self.function) and (recvMsg[2] == 2 * self.count)
+
+
+class WriteRequest(object):
+    """Write single register (0x06) or write multiple registers (0x10) for
+    more registers. The slave echoes the address and the value (0x06) or
+    the nr of registers (0x10) in the response.
+    """
+
+    def __init__(self, slaveAddr, start, values, name):
+        self.slaveAddr = slaveAddr
+        self.start = start
+        self.count = len(values)
+        self.values = values
+        self.name = name
+        if self.count == 1:
+            self.function = WRITE_SINGLE_REGISTER
+            self.pdu = struct.pack('>BHH', self.function, start, values[0])
+        else:
+            self.function = WRITE_MULTIPLE_REGISTERS
+            self.pdu = struct.pack('>BHHB%dH' % self.count, self.function, start, self.count, 2 * self.count, *values)
+        msg = bytes([slaveAddr]) + self.pdu
+        self.frame = msg + modbus.calculateCRCBytes(msg)
+        # Response: modBusAddr, function, address, value or count, CRC
+        self.responseLen = 8
+
+    def __str__(self):
+        return "%s (slave %02Xh, function %02Xh, start %04Xh, count %d)" % (self.name, self.slaveAddr, self.function, self.start, self.count)
+
+    def isResponse(self, recvMsg):
+        # modBusAddr, function, address and value/count must match the request
+        return (recvMsg[0] == self.slaveAddr) and (recvMsg[1:6] == self.pdu[:5])
+
+
+class ModbusMaster(object):
+    """Keep track of the outstanding request on the (half-duplex) bus and
+    match the received frames to it. The request is passed in its
+    busArbiter.Transaction, which gets the send time and exception code. A Modbus exception response ends the
+    request directly, otherwise it ends after the response timeout of the
+    device (see modbusBus.py).
+    """
+
+    def __init__(self):
+        self.pending = None
+        self.timeouts = 0
+        self.exceptions = 0
+        self.unexpected = 0
+
+    def requestTimeout(self):
+        # The response timeout of the pending request is expired
+        if self.pending is not None:
+            print("No response on request %s" % self.pending.request)
+            self.timeouts += 1
+            self.pending = None
+
+    def requestSent(self, transaction, now):
+        transaction.sendTime = now
+        self.pending = transaction
+
+    def responseReceived(self, recvMsg):
+        """Match the received frame to the outstanding request.
+        Returns:
+            The transaction when recvMsg is the response on it, otherwise None.
+        """
+        transaction = self.pending
+        if transaction is None:
+            print("Unexpected msg received, no request outstanding")
+            self.unexpected += 1
+            return None
+
+        result = self.checkResponse(transaction, recvMsg)
+        if result == RESPONSE_MISMATCH:
+            return None
+
+        self.pending = None
+        if result == RESPONSE_EXCEPTION:
+            return None
+        return transaction
+
+    def checkResponse(self, transaction, recvMsg):
+        # recvMsg starts with modBusAddr (RTU frame, or Modbus TCP frame without MBAP header)
+        request = transaction.request
+        if (recvMsg[0] == request.slaveAddr) and (recvMsg[1] == (request.function | 0x80)):
+            exceptionCode = recvMsg[2]
+            print("Modbus exception %02Xh (%s) on request %s" % (exceptionCode, EXCEPTION_CODES.get(exceptionCode, 'Unknown'), request))
+            self.exceptions += 1
+            transaction.exceptionCode = exceptionCode
+            return RESPONSE_EXCEPTION
+
+        if not request.isResponse(recvMsg):
+            print("Received msg doesn't match request %s" % request)
+            self.unexpected += 1
+            return RESPONSE_MISMATCH
+
+        transaction.exceptionCode = None
+        return RESPONSE_OK
@@ -0,0 +1,91 @@
+import struct
+
+# external files/classes
+import modbusMaster
+
+# MBAP header: transaction id, protocol id (0=Modbus), length (unit id + PDU), unit id
+MBAP_HEADER = struct.Struct('>HHHB')
+
+
+class MbapFramer(object):
+    """Cut the received TCP stream into Modbus TCP frames, using the length
+    field of the MBAP header.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def reset(self):
+        del self.buffer[:]
+
+    def feed(self, data):
+        """Add the received bytes.
+        Returns:
+            A list with (transactionId, msg) of the complete frames, where msg
+            starts with the unit id (like a Modbus RTU frame, without CRC).
+        Raises:
+            ValueError when the stream is out of sync (reconnect needed).
+        """
+        self.buffer += data
+
+        frames = []
+        while len(self.buffer) >= MBAP_HEADER.size:
+            transactionId, protocolId, length, _ = MBAP_HEADER.unpack_from(self.buffer)
+            if (protocolId != 0) or (length < 2) or (length > 254):
+                raise ValueError("Invalid MBAP header: %s" % bytes(self.buffer[:MBAP_HEADER.size]).hex())
+
+            frameLen = 6 + length
+            if len(self.buffer) < frameLen:
+                break
+            frames.append((transactionId, bytes(self.buffer[6:frameLen])))
+            del self.buffer[:frameLen]
+        return frames
+
+
+class TcpMaster(modbusMaster.ModbusMaster):
+    """Keep track of the requests in flight on a Modbus TCP connection.
+    Unlike RS485 (half-duplex), several requests can be outstanding at the
+    same time, the responses are matched by their transaction id.
+    """
+
+    def __init__(self):
+        modbusMaster.ModbusMaster.__init__(self)
+        self.inFlight = {}  # transactionId: busArbiter.Transaction
+        self.transactionId = 0
+
+    def reset(self):
+        # Connection is lost: the requests in flight will never be answered
+        self.timeouts += len(self.inFlight)
+        self.inFlight.clear()
+
+    def requestTimeout(self, transactionId):
+        transaction = self.inFlight.pop(transactionId, None)
+        if transaction is not None:
+            print("No response on request %s (transaction %d)" % (transaction.request, transactionId))
+            self.timeouts += 1
+
+    def buildFrame(self, transaction, now):
+        """Register the request as in flight.
+        Returns:
+            The Modbus TCP frame to send.
+        """
+        request = transaction.request
+        self.transactionId = (self.transactionId + 1) & 0xFFFF
+        transaction.sendTime = now
+        self.inFlight[self.transactionId] = transaction
+        return MBAP_HEADER.pack(self.transactionId, 0, len(request.pdu) + 1, request.slaveAddr) + request.pdu
+
+    def responseReceived(self, transactionId, recvMsg):
+        """Match the received frame to the request with the same transaction id.
+        Returns:
+            The transaction when recvMsg is the response on it, otherwise None.
+        """
+        transaction = self.inFlight.pop(transactionId, None)
+        if transaction is None:
+            print("Unexpected msg received, transaction %d is not in flight" % transactionId)
+            self.unexpected += 1
+            return None
+
+        if self.checkResponse(transaction, recvMsg) == modbusMaster.RESPONSE_OK:
+            return transaction
+        return None
@@ -0,0 +1,243 @@
+import json
+import asyncio
+import threading
+from collections import OrderedDict
+import paho.mqtt.client as mqtt_client
+
+# external files/classes
+import settings
+
+# Overflow policies of the publish queue
+POLICY_DROP_OLDEST = 'drop-oldest'  # Queue full: drop the oldest msg
+POLICY_COALESCE = 'coalesce'  # Keep only the newest msg per topic, queue full: drop the oldest
+
+# One long-lived MQTT connection for all publishes and subscriptions. The
+# network I/O of paho runs on the asyncio event loop (no paho thread), see
+# AsyncioHelper.
+client = mqtt_client.Client()
+client.max_inflight_messages_set(settings.MQTT_MAX_INFLIGHT)
+client.max_queued_messages_set(settings.MQTT_MAX_QUEUED)
+
+lastMsgInfo = None
+
+
+class PublishQueue(object):
+    """Bounded hand-off queue between the bus reader and the publish worker.
+    put() never blocks: when the queue is full the oldest msg is dropped, so
+    the bus timing doesn't depend on the health of the network/broker.
+    Only to be used from the event loop.
+    """
+
+    def __init__(self, maxSize, policy):
+        if policy not in (POLICY_DROP_OLDEST, POLICY_COALESCE):
+            raise ValueError("Unknown publish queue policy: %s" % policy)
+        self.maxSize = maxSize
+        self.policy = policy
+        self.msgs = OrderedDict()
+        self.seqNr = 0
+        self.notEmpty = asyncio.Event()
+        self.maxDepth = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def put(self, topic, data, qos=0, retain=False):
+        if self.policy == POLICY_COALESCE:
+            # Same topic is still waiting: replace the data, keep its place in the queue
+            key = topic
+            if key in self.msgs:
+                self.coalesced += 1
+        else:
+            self.seqNr += 1
+            key = self.seqNr
+
+        if (key not in self.msgs) and (len(self.msgs) >= self.maxSize):
+            self.msgs.popitem(last=False)
+            self.dropped += 1
+
+        self.msgs[key] = (topic, data, qos, retain)
+        self.maxDepth = max(self.maxDepth, len(self.msgs))
+        self.notEmpty.set()
+
+    async def get(self):
+        # Returns (topic, data, qos, retain), waits when the queue is empty
+        while not self.msgs:
+            self.notEmpty.clear()
+            await self.notEmpty.wait()
+        return self.msgs.popitem(last=False)[1]
+
+    def getNowait(self):
+        # Returns (topic, data, qos, retain), or None when the queue is empty
+        if not self.msgs:
+            return None
+        return self.msgs.popitem(last=False)[1]
+
+    def depth(self):
+        return len(self.msgs)
+
+
+class AsyncioHelper(object):
+    """Run the paho network I/O on the asyncio event loop: the socket is
+    watched with add_reader/add_writer and loop_misc() (keepalive) is called
+    every second. The (blocking) connect runs in an executor thread, so the
+    paho socket callbacks are passed to the event loop with
+    call_soon_threadsafe() when needed. A lost connection is reconnected with backoff.
+    """
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.loopThreadId = threading.get_ident()
+        self.client = client
+        self.miscTask = None
+        self.disconnected = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def callInLoop(self, callback, *args):
+        # Directly when called from the event loop (the socket is closed right
+        # after the callback), otherwise via call_soon_threadsafe()
+        if threading.get_ident() == self.loopThreadId:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    # Pass the fd, the socket can be closed before the event loop handles the callback
+    def on_socket_open(self, client, userdata, sock):
+        self.callInLoop(self.socketOpened, sock.fileno())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.callInLoop(self.socketClosed, sock.fileno())
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.callInLoop(self.loop.add_writer, sock.fileno(), self.client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.callInLoop(self.loop.remove_writer, sock.fileno())
+
+    def socketOpened(self, fd):
+        self.loop.add_reader(fd, self.client.loop_read)
+        self.miscTask = self.loop.create_task(self.miscLoop())
+
+    def socketClosed(self, fd):
+        self.loop.remove_reader(fd)
+        self.loop.remove_writer(fd)
+        if self.miscTask is not None:
+            self.miscTask.cancel()
+            self.miscTask = None
+        if (self.disconnected is not None) and not self.disconnected.done():
+            self.disconnected.set_result(None)
+
+    async def miscLoop(self):
+        while self.client.loop_misc() == mqtt_client.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    async def run(self):
+        # Keep the connection up, until cancelled
+        reconnectDelay = settings.RECONNECT_DELAY_MIN
+        while True:
+            self.disconnected = self.loop.create_future()
+            try:
+                # connect_async() has set the broker address
+                await self.loop.run_in_executor(None, self.client.reconnect)
+                reconnectDelay = settings.RECONNECT_DELAY_MIN
+                await self.disconnected
+                print("MQTT connection lost, reconnect in %g sec" % reconnectDelay)
+            except (OSError, ValueError) as arg:
+                print("MQTT connect failed: %s, retry in %g sec" % (str(arg), reconnectDelay))
+            await asyncio.sleep(reconnectDelay)
+            # Backoff: don't hammer a broker which is down
+            reconnectDelay = min(2 * reconnectDelay, settings.RECONNECT_DELAY_MAX)
+
+
+publishQueue = None
+helper = None
+connectionTask = None
+workerTask = None
+
+
+async def publishWorker():
+    # Runs until stop() cancels it
+    while True:
+        topic, data, qos, retain = await publishQueue.get()
+        publishJson(topic, data, qos, retain)
+
+
+def publishJson(topic, data, qos, retain):
+    try:
+        publish(topic, json.dumps(data, separators=(', ', ':')), qos=qos, retain=retain)
+    except Exception as arg:
+        print("Exception in publishWorker topic:%s: %s" % (topic, str(arg)))
+
+
+def start():
+    # To be called from the event loop
+    global publishQueue, helper, connectionTask, workerTask
+
+    loop = asyncio.get_running_loop()
+    publishQueue = PublishQueue(settings.PUBLISH_QUEUE_SIZE, settings.PUBLISH_QUEUE_POLICY)
+    helper = AsyncioHelper(loop, client)
+
+    # connect_async: only store the broker address, the connect is done by helper.run()
+    client.connect_async(settings.MQTT_ServerIP, settings.MQTT_ServerPort, 60)
+    connectionTask = loop.create_task(helper.run())
+    workerTask = loop.create_task(publishWorker())
+
+
+def publishData(topic, data, qos=0, retain=False):
+    # Hand-off to the publish worker, data (dict) is converted to JSON there
+    publishQueue.put(topic, data, qos, retain)
+
+
+def publish(topic, payload, qos=0, retain=False):
+    global lastMsgInfo
+
+    lastMsgInfo = client.publish(topic, payload, qos=qos, retain=retain)
+    # QoS>0 msgs are kept by paho and sent after the reconnect
+    if (lastMsgInfo.rc != mqtt_client.MQTT_ERR_SUCCESS) and not ((qos > 0) and (lastMsgInfo.rc == mqtt_client.MQTT_ERR_NO_CONN)):
+        print("MQTT publish to %s failed: %s" % (topic, mqtt_client.error_string(lastMsgInfo.rc)))
+    return lastMsgInfo
+
+
+def getStats():
+    return {
+        'queueDepth': publishQueue.depth(),
+        'queueMaxDepth': publishQueue.maxDepth,
+        'dropped': publishQueue.dropped,
+        'coalesced': publishQueue.coalesced,
+    }
+
+
+async def flush(timeout):
+    # Msgs are sent in order, so waiting for the last one is enough
+    endTime = asyncio.get_running_loop().time() + timeout
+    while (lastMsgInfo is not None) and (lastMsgInfo.rc == mqtt_client.MQTT_ERR_SUCCESS) and not lastMsgInfo.is_published():
+        if asyncio.get_running_loop().time() >= endTime:
+            print("MQTT flush timeout, not all msgs are published")
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+
+async def stop():
+    # First hand over the queued msgs to paho
+    workerTask.cancel()
+    msg = publishQueue.getNowait()
+    while msg is not None:
+        publishJson(*msg)
+        msg = publishQueue.getNowait()
+    print("MQTT publish stats: %s" % getStats())
+
+    await flush(settings.MQTT_FLUSH_TIMEOUT)
+
+    # No reconnect (and no "connection lost") after the disconnect
+    connectionTask.cancel()
+    await asyncio.gather(workerTask, connectionTask, return_exceptions=True)
+
+    # The DISCONNECT packet is sent by the event loop, wait for the close of the socket
+    helper.disconnected = asyncio.get_running_loop().create_future()
+    if client.disconnect() == mqtt_client.MQTT_ERR_SUCCESS:
+        try:
+            await asyncio.wait_for(helper.disconnected, 1.0)
+        except asyncio.TimeoutError:
+            pass
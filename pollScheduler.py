@@ -0,0 +1,114 @@
+import asyncio
+import time
+import heapq
+
+
+class PollJob(object):
+    """A job which is run every period seconds.
+    Args:
+        * name (str): Used in the log msgs
+        * action (function): Called without arguments when the job is due,
+          returns False when the job is skipped (backpressure of the bus)
+        * period (float): [sec] Time between two runs
+        * phase (float): [sec] Offset of the first run after the scheduler start
+        * jitterBudget (float): [sec] Max lateness before it is counted as a missed deadline
+        * busTime (float): [sec] Estimated bus time of one run (see PollScheduler.busLoad())
+    """
+
+    def __init__(self, name, action, period, phase=0.0, jitterBudget=0.5, busTime=0.0):
+        self.name = name
+        self.action = action
+        self.period = period
+        self.phase = phase
+        self.jitterBudget = jitterBudget
+        self.busTime = busTime
+        self.nextDue = None
+        self.seqNr = None  # Of the valid heap entry, older entries are skipped
+        self.missedDeadlines = 0
+        self.maxLateness = 0.0
+        self.deferred = 0
+
+
+class PollScheduler(object):
+    """Run the jobs on their deadlines, based on the monotonic clock.
+    The next deadline is calculated from the previous deadline (not from the
+    time the job was run), so the schedule doesn't drift.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.seqNr = 0  # Keeps the heap order stable for jobs with the same deadline
+        self.wakeup = asyncio.Event()  # A job is (re)scheduled: run() calculates its sleep again
+
+    def addJob(self, job, now=None):
+        if now is None:
+            now = time.monotonic()
+        job.nextDue = now + job.phase
+        self.push(job)
+
+    def push(self, job):
+        self.seqNr += 1
+        job.seqNr = self.seqNr
+        heapq.heappush(self.heap, (job.nextDue, self.seqNr, job))
+        self.wakeup.set()
+
+    def setPeriod(self, job, period, now=None):
+        """Change the period of the job. A shorter period takes effect
+        directly: the next run is moved forward to the last run + period.
+        """
+        if now is None:
+            now = time.monotonic()
+        lastDue = job.nextDue - job.period
+        job.period = period
+        nextDue = max(lastDue + period, now)
+        if nextDue < job.nextDue:
+            job.nextDue = nextDue
+            self.push(job)
+
+    def busLoad(self):
+        # Estimated fraction of the bus time used by the jobs
+        jobs = {id(job): job for _, _, job in self.heap}.values()
+        return sum(job.busTime / job.period for job in jobs)
+
+    def timeToNextJob(self, now):
+        if not self.heap:
+            return None
+        return max(0.0, self.heap[0][0] - now)
+
+    def runDueJobs(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        while self.heap and (self.heap[0][0] <= now):
+            _, seqNr, job = heapq.heappop(self.heap)
+            if seqNr != job.seqNr:
+                # Rescheduled by setPeriod()
+                continue
+
+            lateness = now - job.nextDue
+            job.maxLateness = max(job.maxLateness, lateness)
+            if lateness > job.jitterBudget:
+                job.missedDeadlines += 1
+                print("Missed deadline of job %s by %.3f sec (missed: %d)" % (job.name, lateness, job.missedDeadlines))
+
+            if job.action() is False:
+                job.deferred += 1
+
+            job.nextDue += job.period
+            if job.nextDue <= now:
+                # Way too late: skip the runs in the past instead of catching up with a burst
+                skipped = int((now - job.nextDue) // job.period) + 1
+                job.nextDue += skipped * job.period
+            self.push(job)
+
+    async def run(self):
+        """Run the jobs until the task is cancelled, sleep until the next
+        deadline or until a job is (re)scheduled, like by setPeriod().
+        """
+        while True:
+            self.runDueJobs()
+            self.wakeup.clear()
+            timeToNextJob = self.timeToNextJob(time.monotonic())
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), 3600 if timeToNextJob is None else timeToNextJob)
+            except asyncio.TimeoutError:
+                pass
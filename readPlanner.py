@@ -0,0 +1,72 @@
+# external files/classes
+import registerMap
+
+MAX_READ_COUNT = 125  # Max nr of registers of one read request (function 0x03)
+
+
+def fieldSize(field):
+    # Nr of 16 bit registers
+    return registerMap.REGISTER_TYPES[field.type][1]
+
+
+class PlannedRead(object):
+    """One read request of a poll plan: the registers start..start+count-1,
+    holding the fields of one or more register blocks. decode() returns the
+    data per block; lastPart is True in the read with the last fields of the
+    block, then all fields of the block are received in this poll.
+    """
+
+    def __init__(self, start, count, blockFields):
+        # blockFields: [(block, fields)] of the fields in this read
+        self.start = start
+        self.count = count
+        self.name = '+'.join(block.name for block, _ in blockFields)
+        self.parts = [(block, registerMap.BlockDecoder(start, count, fields)) for block, fields in blockFields]
+        self.lastParts = set()  # Names of the blocks with their last fields in this read
+        # Response length: modBusAddr, function, byte count, data, CRC
+        self.msgLen = 5 + 2 * count
+
+    def decode(self, recvMsg):
+        # Returns [(block, data, lastPart)]
+        return [(block, decoder.decode(recvMsg), block.name in self.lastParts) for block, decoder in self.parts]
+
+
+def planReads(blockFields, maxGap):
+    """Plan the read requests for the fields of the blocks.
+    The fields are sorted by address, then the registers are merged into one
+    read as long as the gap between the fields is max maxGap registers and
+    the read is max MAX_READ_COUNT registers. The not used registers in a
+    gap cost 2 bytes each, a request more costs a turnaround on the bus.
+    Args:
+        * blockFields: [(block, fields)], the needed fields per register block
+        * maxGap: Max nr of not used registers which are read to save a request
+    Returns:
+        The list of PlannedRead.
+    """
+    allFields = sorted(((field, block) for block, fields in blockFields for field in fields), key=lambda f: f[0].address)
+
+    ranges = []  # [start, end, [(field, block)]]
+    for field, block in allFields:
+        fieldEnd = field.address + fieldSize(field)
+        if ranges:
+            start, end, rangeFields = ranges[-1]
+            if ((field.address - end) <= maxGap) and ((max(end, fieldEnd) - start) <= MAX_READ_COUNT):
+                ranges[-1][1] = max(end, fieldEnd)
+                rangeFields.append((field, block))
+                continue
+        ranges.append([field.address, fieldEnd, [(field, block)]])
+
+    reads = []
+    for start, end, rangeFields in ranges:
+        # Keep the order of the blocks, collect the fields per block
+        fieldsPerBlock = {}
+        for field, block in rangeFields:
+            fieldsPerBlock.setdefault(block, []).append(field)
+        reads.append(PlannedRead(start, end - start, list(fieldsPerBlock.items())))
+
+    # The last read with fields of a block completes the block
+    for read in reversed(reads):
+        for block, _ in read.parts:
+            if not any(block.name in laterRead.lastParts for laterRead in reads):
+                read.lastParts.add(block.name)
+    return reads
@@ -0,0 +1,237 @@
+import struct
+from collections import namedtuple
+
+# Register types: struct format code and nr of 16 bit registers
+REGISTER_TYPES = {
+    'int16':  ('h', 1),
+    'uint16': ('H', 1),
+    'int32':  ('i', 2),
+    'uint32': ('I', 2),
+}
+
+# Volatility classes of the fields, see POLL_SCHEDULE in settings.py
+FAST = 'fast'      # Changes within seconds, read in a small, frequent request
+NORMAL = 'normal'  # Read at the cadence of the block
+STATIC = 'static'  # (Practically) never changes: read at startup, then with a long interval
+
+# name:    Key in the published JSON data
+# address: Modbus register address
+# type:    See REGISTER_TYPES
+# scale:   Divider for the raw value (1=raw integer value)
+# unit:    Only for documentation
+# deadband:    Report by exception: min absolute change of the (scaled) value to publish again (0=every change)
+# relDeadband: Same, relative to the last published value (0.05=5%), the biggest deadband is used
+# volatility:  FAST, NORMAL or STATIC
+# offset:  Subtracted from the (scaled) value, like the 32000 of the dispatch power
+# limits:  (min, max) of the value, only fields with limits can be written (see controlWriter.py)
+Field = namedtuple('Field', ['name', 'address', 'type', 'scale', 'unit', 'deadband', 'relDeadband', 'volatility', 'offset', 'limits'],
+                   defaults=(0, 0, NORMAL, 0, None))
+
+
+def encodeValue(field, value):
+    """Convert the value to the register values (uint16) to write.
+    Raises:
+        ValueError when the field can't be written or the value is outside its limits.
+    """
+    if field.limits is None:
+        raise ValueError("%s is read only" % field.name)
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError("%s: %r is not a number" % (field.name, value))
+    minValue, maxValue = field.limits
+    if not (minValue <= value <= maxValue):
+        raise ValueError("%s: %g is outside %g..%g" % (field.name, value, minValue, maxValue))
+    formatCode, size = REGISTER_TYPES[field.type]
+    raw = struct.pack('>' + formatCode, round((value + field.offset) * field.scale))
+    return struct.unpack('>%dH' % size, raw)
+
+
+class BlockDecoder(object):
+    """Decode the data of a read response (function 0x03) for the registers
+    start..start+count-1. The fields are compiled into one struct.Struct, so
+    a whole frame is decoded by a single unpack_from() call.
+    """
+
+    def __init__(self, start, count, fields):
+        self.start = start
+        self.count = count
+
+        formatString = '>'
+        address = start
+        names = []
+        scales = []
+        offsets = []
+        for field in sorted(fields, key=lambda f: f.address):
+            formatCode, size = REGISTER_TYPES[field.type]
+            if (field.address < address) or (field.address + size > start + count):
+                raise ValueError("Field %s at %04Xh overlaps or is outside block %04Xh-%04Xh" % (field.name, field.address, start, start + count - 1))
+            if field.address > address:
+                # Skip the not used registers
+                formatString += '%dx' % (2 * (field.address - address))
+            formatString += formatCode
+            address = field.address + size
+            names.append(field.name)
+            scales.append(field.scale)
+            offsets.append(field.offset)
+        if address < start + count:
+            formatString += '%dx' % (2 * (start + count - address))
+
+        self.struct = struct.Struct(formatString)
+        self.names = tuple(names)
+        self.scales = tuple(scales)
+        self.offsets = tuple(offsets)
+
+    def decode(self, recvMsg):
+        # Data starts after modBusAddr, function and byte count
+        values = self.struct.unpack_from(recvMsg, 3)
+        return {name: (value if scale == 1 else value / scale) - offset for name, value, scale, offset in zip(self.names, values, self.scales, self.offsets)}
+
+
+class RegisterBlock(object):
+    """A block of registers, read with one request and published on one topic.
+    The data is published again when a field is out of its deadband, or when
+    it is not published for heartbeat seconds.
+    """
+
+    def __init__(self, name, start, count, topic, fields, heartbeat):
+        self.name = name
+        self.start = start
+        self.count = count
+        self.topic = topic
+        self.fields = fields
+        self.heartbeat = heartbeat
+
+    def getFields(self, volatility):
+        return [field for field in self.fields if field.volatility == volatility]
+
+    def getField(self, name):
+        # Returns None when there is no field with this name
+        for field in self.fields:
+            if field.name == name:
+                return field
+        return None
+
+
+# To publish an extra value: add (or uncomment) the field in the table
+#                        name, address, type, scale, unit[, deadband[, relDeadband]][, volatility=]
+METER_FIELDS = [
+    Field('Pphase_a',      0x0000, 'int32',  1,   'W', 20, 0.02, FAST),
+    Field('Pphase_b',      0x0002, 'int32',  1,   'W', 20, 0.02, FAST),
+    Field('Pphase_c',      0x0004, 'int32',  1,   'W', 20, 0.02, FAST),
+    Field('Pactive',       0x0006, 'int32',  1,   'W', 20, 0.02, FAST),
+    Field('Egrid',         0x0008, 'int32',  100, 'kWh'),
+    Field('Econs',         0x000A, 'int32',  100, 'kWh'),
+    # Field('PVphase_a',   0x000C, 'int32',  1,   'W'),
+    # Field('PVphase_b',   0x000E, 'int32',  1,   'W'),
+    # Field('PVphase_c',   0x0010, 'int32',  1,   'W'),
+    # Field('PVactive',    0x0012, 'int32',  1,   'W'),
+    # Field('PVgrid',      0x0014, 'uint32', 100, 'kWh'),
+]
+
+BATTERY_FIELDS = [
+    Field('Ubatt',                0x0100, 'int16',  10,   'V', 0.2, volatility=FAST),
+    Field('Ibatt',                0x0101, 'int16',  10,   'A', 0.2, volatility=FAST),
+    Field('SOC',                  0x0102, 'int16',  10,   '%',      volatility=FAST),
+    Field('Status',               0x0103, 'int16',  1,    ''),
+    Field('Relay_status',         0x0104, 'int16',  1,    ''),
+    # Field('PackID_Umin',        0x0105, 'uint16', 1,    ''),
+    # Field('CellID_Umin',        0x0106, 'uint16', 1,    ''),
+    Field('Umin',                 0x0107, 'int16',  1000, 'V', 0.005),
+    # Field('PackID_Umax',        0x0108, 'uint16', 1,    ''),
+    # Field('CellID_Umax',        0x0109, 'uint16', 1,    ''),
+    Field('Umax',                 0x010A, 'int16',  1000, 'V', 0.005),
+    # Field('PackID_Tmin',        0x010B, 'uint16', 1,    ''),
+    # Field('CellID_Tmin',        0x010C, 'uint16', 1,    ''),
+    Field('Tmin',                 0x010D, 'int16',  10,   '℃', 0.5),
+    # Field('PackID_Tmax',        0x010E, 'uint16', 1,    ''),
+    # Field('CellID_Tmax',        0x010F, 'uint16', 1,    ''),
+    Field('Tmax',                 0x0110, 'int16',  10,   '℃', 0.5),
+    Field('Icharge_max',          0x0111, 'int16',  10,   'A'),
+    Field('Idischarge_max',       0x0112, 'int16',  10,   'A'),
+    Field('Ucharge_cut_off',      0x0113, 'int16',  10,   'V',      volatility=STATIC),
+    Field('Udischarge_cut_off',   0x0114, 'int16',  10,   'V',      volatility=STATIC),
+    # Field('BMU_version',        0x0115, 'uint16', 1,    '',       volatility=STATIC),
+    # Field('LMU_version',        0x0116, 'uint16', 1,    '',       volatility=STATIC),
+    # Field('ISO_version',        0x0117, 'uint16', 1,    '',       volatility=STATIC),
+    # Field('Battery_num',        0x0118, 'uint16', 1,    '',       volatility=STATIC),
+    # Field('Capacity',           0x0119, 'uint16', 10,   'kWh',    volatility=STATIC),
+    # Field('Battery_type',       0x011A, 'uint16', 1,    '',       volatility=STATIC),
+    Field('SOH',                  0x011B, 'int16',  10,   '%'),
+    Field('Warning',              0x011C, 'int32',  1,    ''),
+    Field('Fault',                0x011E, 'int32',  1,    ''),
+    Field('Echarge',              0x0120, 'int32',  10,   'kWh'),
+    Field('Edischarge',           0x0122, 'int32',  10,   'kWh'),
+    Field('Echarge_from_grid',    0x0124, 'int32',  10,   'kWh'),
+]
+
+INVERTER_FIELDS = [
+    Field('Uinv_L1',       0x0400, 'int16',  10,  'V', 1.0),
+    Field('Uinv_L2',       0x0401, 'int16',  10,  'V', 1.0),
+    Field('Uinv_L3',       0x0402, 'int16',  10,  'V', 1.0),
+    # Field('Iinv_L1',     0x0403, 'int16',  10,  'A'),
+    # Field('Iinv_L2',     0x0404, 'int16',  10,  'A'),
+    # Field('Iinv_L3',     0x0405, 'int16',  10,  'A'),
+    # Field('Pinv_L1',     0x0406, 'int32',  1,   'W'),
+    # Field('Pinv_L2',     0x0408, 'int32',  1,   'W'),
+    # Field('Pinv_L3',     0x040A, 'int32',  1,   'W'),
+    Field('Pinv',          0x040C, 'int32',  1,   'W', 20, 0.02),
+    Field('Uback_L1',      0x040E, 'int16',  10,  'V', 1.0),
+    Field('Uback_L2',      0x040F, 'int16',  10,  'V', 1.0),
+    Field('Uback_L3',      0x0410, 'int16',  10,  'V', 1.0),
+    # Field('Iback_L1',    0x0411, 'uint16', 10,  'A'),
+    # Field('Iback_L2',    0x0412, 'uint16', 10,  'A'),
+    # Field('Iback_L3',    0x0413, 'uint16', 10,  'A'),
+    # Field('Pback_L1',    0x0414, 'uint32', 1,   'W'),
+    # Field('Pback_L2',    0x0416, 'uint32', 1,   'W'),
+    # Field('Pback_L3',    0x0418, 'uint32', 1,   'W'),
+    Field('Pback',         0x041A, 'int32',  1,   'W', 20, 0.02),
+    # Field('Fgrid',       0x041C, 'uint16', 100, 'Hz'),
+    Field('U_PV1',         0x041D, 'int16',  10,  'V', 2.0),
+    Field('I_PV1',         0x041E, 'int16',  10,  'A', 0.1),
+    Field('P_PV1',         0x041F, 'int32',  1,   'W', 20, 0.02),
+    Field('U_PV2',         0x0421, 'int16',  10,  'V', 2.0),
+    Field('I_PV2',         0x0422, 'int16',  10,  'A', 0.1),
+    Field('P_PV2',         0x0423, 'int32',  1,   'W', 20, 0.02),
+    # Field('U_PV3',       0x0425, 'uint16', 10,  'V'),
+    # Field('I_PV3',       0x0426, 'uint16', 10,  'A'),
+    # Field('P_PV3',       0x0427, 'uint32', 1,   'W'),
+    Field('TempInv',       0x0429, 'int16',  10,  '℃', 0.5),
+    Field('Warning',       0x042A, 'int32',  1,   ''),
+    Field('Fault',         0x042C, 'int32',  1,   ''),
+    # Field('Epv',         0x042E, 'uint32', 10,  'kWh'),
+]
+
+SYSTEM_FIELDS = [
+    Field('Feed_into_grid', 0x0700, 'uint16', 1,  '%'),
+    Field('Fault',          0x0701, 'uint32', 1,  ''),
+    Field('Year_month',     0x0703, 'uint16', 1,  ''),
+    Field('Day_hour',       0x0704, 'uint16', 1,  ''),
+    Field('Minute_second',  0x0705, 'uint16', 1,  ''),
+]
+
+# Dispatch and battery control, written via MQTT (see controlWriter.py)
+#                        name, address, type, scale, unit, limits=(min, max)
+CONTROL_FIELDS = [
+    Field('Dispatch_start',       0x0722, 'uint16', 1,   '',  limits=(0, 1)),  # 1=start, 0=stop
+    Field('Dispatch_power',       0x0723, 'int32',  1,   'W', offset=32000, limits=(-10000, 10000)),  # <0 charge, >0 discharge
+    # Field('Dispatch_reactive',  0x0725, 'int32',  1,   'Var', offset=32000, limits=(-10000, 10000)),
+    Field('Dispatch_mode',        0x0727, 'uint16', 1,   '',  limits=(1, 10)),  # Protocol note 7
+    Field('Dispatch_SOC',         0x0728, 'uint16', 2.5, '%', limits=(0, 100)),  # 0.4%/bit
+    # Field('EMS_version_high',   0x0729, 'uint16', 1,   '',  volatility=STATIC),
+    # Field('EMS_version_middle', 0x072A, 'uint16', 1,   '',  volatility=STATIC),
+    # Field('EMS_version_low',    0x072B, 'uint16', 1,   '',  volatility=STATIC),
+    Field('User_mode',            0x072C, 'uint16', 1,   '',  limits=(0, 2)),  # 0=green, 1=economic, 2=secure
+    Field('Battery_mode',         0x072D, 'uint16', 1,   '',  limits=(0, 3)),  # 0=auto, 1=charge, 2=discharge, 3=standby
+    Field('Battery_power',        0x072E, 'int16',  1,   'W', limits=(0, 10000)),  # In charge or discharge mode
+]
+
+# topic: relative to the topic prefix of the device (see settings.DEVICES)
+meterBlock = RegisterBlock('Meter', 0x0000, 0x16, "Meter/power", METER_FIELDS, heartbeat=900)
+batteryBlock = RegisterBlock('Battery', 0x0100, 0x26, "Battery/power", BATTERY_FIELDS, heartbeat=900)
+inverterBlock = RegisterBlock('Inverter', 0x0400, 0x30, "Inverter/power", INVERTER_FIELDS, heartbeat=60)
+systemBlock = RegisterBlock('System', 0x0700, 0x06, "System/status", SYSTEM_FIELDS, heartbeat=3600)
+controlBlock = RegisterBlock('Control', 0x0722, 0x0D, "Control/status", CONTROL_FIELDS, heartbeat=3600)
+
+# Register map per device type, name is used in settings.DEVICES
+REGISTER_MAPS = {
+    'storion-t10': (meterBlock, batteryBlock, inverterBlock, systemBlock, controlBlock),
+}
@@ -0,0 +1,38 @@
+import time
+
+
+class ReportFilter(object):
+    """Report by exception for the data of one topic.
+    The data is only published again when one of the values is changed more
+    than its deadband, compared with the last published value, or when the
+    data isn't published for heartbeat seconds.
+    """
+
+    def __init__(self, fields, heartbeat):
+        self.deadbands = {field.name: (field.deadband, field.relDeadband) for field in fields}
+        self.heartbeat = heartbeat
+        self.lastData = None
+        self.lastReportTime = None
+        self.suppressed = 0
+
+    def outOfDeadband(self, data):
+        for name, value in data.items():
+            lastValue = self.lastData.get(name)
+            if lastValue is None:
+                return True
+            # Values not in the register map are published on every change (calculated values are added after the filter)
+            deadband, relDeadband = self.deadbands.get(name, (0, 0))
+            if abs(value - lastValue) > max(deadband, relDeadband * abs(lastValue)):
+                return True
+        return False
+
+    def check(self, data, now=None):
+        """Returns True when data has to be published (and remembers it as the last published data)."""
+        if now is None:
+            now = time.monotonic()
+        if (self.lastData is None) or ((now - self.lastReportTime) >= self.heartbeat) or self.outOfDeadband(data):
+            self.lastData = dict(data)
+            self.lastReportTime = now
+            return True
+        self.suppressed += 1
+        return False
@@ -0,0 +1,120 @@
+import time
+
+# external files/classes
+import modbus
+import settings
+
+
+def charTime(baudrate, bitsPerChar=10):
+    # Transmit time of one char, 8N1: start bit, 8 data bits, stop bit
+    return bitsPerChar / baudrate
+
+
+def frameGapTime(baudrate):
+    # Modbus RTU: frames are separated by a silence of 3.5 chars (11 bits/char),
+    # above 19200 baud the spec uses a fixed 1.75ms
+    if baudrate > 19200:
+        return 0.00175
+    return 3.5 * 11 / baudrate
+
+
+def expectedFrameLength(buffer):
+    """Get the length of the frame at the start of the buffer.
+    Returns:
+        The frame length including the CRC, None if more bytes are needed to
+        know it, or 0 if the start of the buffer can't be a valid frame.
+    """
+    if len(buffer) < 2:
+        return None
+
+    # 0=broadcast (no answer), 248..255=reserved
+    if (buffer[0] == 0) or (buffer[0] > 247):
+        return 0
+
+    function = buffer[1]
+    if function & 0x80:
+        # Exception: addr, function, exception code, CRC
+        return 5
+    if function in (0x01, 0x02, 0x03, 0x04):
+        # Read response: addr, function, byte count, data, CRC
+        if len(buffer) < 3:
+            return None
+        return 5 + buffer[2]
+    if function in (0x05, 0x06, 0x0F, 0x10):
+        # Write response: addr, function, address, value/count, CRC
+        return 8
+    return 0
+
+
+class RtuFramer(object):
+    """Cut the received byte stream into Modbus RTU frames.
+    The bytes are passed to feed() as soon as they are read, a frame is
+    returned as soon as its last CRC byte is received. The frame length is
+    derived from the function code and byte count field, the CRC is
+    calculated while the bytes are coming in. On a CRC failure or garbage
+    it resynchronises by skipping one byte at a time. A partial frame is
+    dropped when the line is silent for longer than the frame gap.
+    """
+
+    def __init__(self, baudrate, minFrameGap=None):
+        # USB adapters (and serial servers) deliver the bytes in chunks, so the
+        # 3.5 char gap is only used when it is longer than the minimal gap
+        if minFrameGap is None:
+            minFrameGap = settings.RTU_FRAME_GAP_MIN
+        self.frameGap = max(frameGapTime(baudrate), minFrameGap)
+        self.buffer = bytearray()
+        self.crc = modbus.CRC16()
+        self.crcLen = 0  # Nr of buffer bytes already in self.crc
+        self.lastRxTime = 0.0
+        self.droppedBytes = 0
+
+    def reset(self):
+        self.droppedBytes += len(self.buffer)
+        del self.buffer[:]
+        self.crc.reset()
+        self.crcLen = 0
+
+    def skipByte(self):
+        self.droppedBytes += 1
+        del self.buffer[:1]
+        self.crc.reset()
+        self.crcLen = 0
+
+    def feed(self, data, now=None):
+        """Add the received bytes.
+        Returns:
+            A list with the complete frames (bytes), including the CRC.
+        """
+        if now is None:
+            now = time.monotonic()
+        if self.buffer and ((now - self.lastRxTime) > self.frameGap):
+            # Silence on the line: the partial frame is never completed
+            self.reset()
+        self.lastRxTime = now
+        self.buffer += data
+
+        frames = []
+        while self.buffer:
+            frameLen = expectedFrameLength(self.buffer)
+            if frameLen is None:
+                break
+            if frameLen == 0:
+                self.skipByte()
+                continue
+
+            if len(self.buffer) < frameLen:
+                # Frame not complete yet, already calculate the CRC of the new bytes
+                self.crc.update(self.buffer[self.crcLen:])
+                self.crcLen = len(self.buffer)
+                break
+
+            self.crc.update(self.buffer[self.crcLen:frameLen])
+            if self.crc.frameOK():
+                frames.append(bytes(self.buffer[:frameLen]))
+                del self.buffer[:frameLen]
+                self.crc.reset()
+                self.crcLen = 0
+            else:
+                self.skipByte()
+
+        return frames
@@ -1,9 +1,9 @@
-import paho.mqtt.publish as mqtt_publish
 import json
 import time
 
 # external files/classes
 import settings
+import mqttPublisher
 
 # System check
 ACTION_NOTHING = 0
@@ -41,7 +41,7 @@ def sendCheckReportToHomeLogic(fail, action, msg):
     checkReport['checkFail'] = checkFail
     checkReport['checkAction'] = checkAction
     checkReport['checkMsg'] = checkMsg
-    mqtt_publish.single(settings.MQTT_TOPIC_REPORT, json.dumps(checkReport), qos=1, hostname=settings.MQTT_ServerIP)
+    mqttPublisher.publish(settings.MQTT_TOPIC_REPORT, json.dumps(checkReport), qos=1)
 
 
 # Don't wait for the Home Logic system checker, report it directly
@@ -2,19 +2,108 @@ import logging
 
 MQTT_ServerIP      = "192.168.5.248"
 MQTT_ServerPort    = 1883
+MQTT_MAX_INFLIGHT  = 20   # Max QoS>0 msgs waiting for an ack from the broker
+MQTT_MAX_QUEUED    = 100  # Max msgs queued while the broker is unreachable
+MQTT_FLUSH_TIMEOUT = 5    # [sec] Time to wait for pending msgs at shutdown
 
-serialPortDevice   = '/dev/ttyUSB0'
-serialPortBaudrate = 9600
+PUBLISH_QUEUE_SIZE   = 50          # Max msgs waiting for the publish worker
+PUBLISH_QUEUE_POLICY = 'coalesce'  # Queue overflow: 'coalesce' (newest per topic) or 'drop-oldest'
+REPORT_BY_EXCEPTION  = True        # Only publish on changes (deadbands) and heartbeat, see registerMap.py
+
+# Modbus buses, name: (transport, port), all buses are used at the same time
+# 'rtu':     RS485 on a serial port, port: device
+# 'rtu-tcp': RS485 via a serial server (Moxa NPort), port: (IP address, TCP port)
+# 'tcp':     Modbus TCP, port: (IP address, TCP port)
+# 'rtu' and 'rtu-tcp' take the baud rate of the RS485 line as optional 3rd item, default serialPortBaudrate
+BUSES = {
+    'rs485':         ('rtu',     '/dev/ttyUSB0'),
+    # 'rs485-2':     ('rtu',     '/dev/ttyUSB1', 19200),
+    # 'nport':       ('rtu-tcp', ('192.168.5.225', 4004), 19200),
+    # 'storion-tcp': ('tcp',     ('192.168.5.226', 502)),
+}
+
+serialPortBaudrate    = 9600     # Of the RS485 buses without their own baud rate in BUSES
+RS485_TURNAROUND      = 'drain'  # 'drain': RTS off after tcdrain and the transmit time, 'kernel': RS485 mode of the driver
+RESPONSE_TIMEOUT      = 1.0   # [sec] Max wait for the response on a request (the adaptive timeout is never longer)
+RESPONSE_TIMEOUT_MIN  = 0.05  # [sec] Min adaptive response timeout
+RESPONSE_TIMEOUT_PERCENTILE = 0.99  # Adaptive response timeout: latency percentile * margin
+RESPONSE_TIMEOUT_MARGIN     = 2.0
+LATENCY_WINDOW        = 200   # Nr of last latencies (request to first byte) per device for the percentile
+LATENCY_MIN_SAMPLES   = 20    # Until then RESPONSE_TIMEOUT is used
+RESPONSE_RETRIES      = 1     # After a timeout the request is sent again directly, with RESPONSE_TIMEOUT
+RTU_FRAME_GAP_MIN     = 0.02  # [sec] Min silence between frames (USB adapters deliver bytes in chunks)
+SLAVE_RESPONSE_TIME   = 0.05  # [sec] Estimated time the slave needs to answer, for the bus load
+
+TCP_MAX_IN_FLIGHT      = 4     # Max requests waiting for a response on the TCP connection
+
+GATEWAY_FRAME_GAP_MIN  = 0.1   # [sec] Min silence between frames (the network adds jitter)
+
+TX_QUEUE_SIZE          = 16    # Max requests waiting per bus
+TX_QUEUE_HIGH_WATER    = 8     # Backpressure: above this nr of waiting requests the polls are skipped
+
+RECONNECT_DELAY_MIN    = 1     # [sec] First retry after a lost TCP/MQTT connection
+RECONNECT_DELAY_MAX    = 60    # [sec] Backoff: the retry delay doubles up to this
 
 LOG_FILENAME       = "/home/pi/log/alpha-ess-modbus_mqtt.log"
 LOG_LEVEL          = logging.INFO  # Could be e.g. "INFO", "DEBUG" or "WARNING"
 
-MQTT_TOPIC_CONTROL = 'huis/AlphaEss/+/control'
+MQTT_TOPIC_CONTROL = 'huis/AlphaEss/+/control'  # + is the device name (see DEVICES), payload: {field name: value}
 
 MQTT_TOPIC_CHECK   = "huis/AlphaEss/RPiInfra/check"
 MQTT_TOPIC_REPORT  = "huis/AlphaEss/RPiInfra/report"
+MQTT_TOPIC_METRICS = "huis/AlphaEss/RPiInfra/metrics"
+
+# Modbus slaves: (name, bus, slave address, register map, topic prefix)
+# Register maps: see registerMap.REGISTER_MAPS
+DEVICES = [
+    ('Storion', 'rs485', 0x55, 'storion-t10', 'huis/AlphaEss'),
+    # ('Storion-2', 'rs485', 0x56, 'storion-t10', 'huis/AlphaEss-2'),
+]
+DEVICE_OFFLINE_AFTER  = 3   # Nr of requests without response, before a device is offline
+DEVICE_PROBE_INTERVAL = 60  # [sec] Offline device: only one request per interval
+CONTROL_MIN_INTERVAL = 1.0  # [sec] Control writes: setpoints received within the interval are merged (last write wins)
+
+# Poll schedule: (register blocks, period, phase offset, jitter budget)  [sec]
+# The phase offset of each next device is shifted with period/nr of devices
+# The fields of the blocks with the same cadence are read with as few requests as possible
+# 'Block' are the normal fields of the block, 'Block/fast' and 'Block/static' the fields
+# with that volatility (see registerMap.py). Static fields: read at startup, then once a day
+POLL_SCHEDULE = [
+    (('Battery/static',),    86400, 0.1, 10),
+    (('Battery',),           300,   0.3, 1.0),
+    (('Battery/fast',),      5,     1.3, 0.5),
+    (('Inverter',),          2.5,   2.8, 0.5),
+    # (('Meter', 'Meter/fast', 'System'), 900, 1.5, 0.5),
+]
+# Adaptive poll rate of POLL_SCHEDULE entries: (key fields, rate threshold [unit/sec], min period, max period)
+# Polled every min period when a key field changes faster than the threshold, when the
+# values are stable the period grows to max period
+ADAPTIVE_POLL = {
+    ('Inverter',):      (('Pinv', 'P_PV1', 'P_PV2'), 50,  1.0, 30),
+    ('Battery/fast',):  (('Ibatt',),                 0.5, 2.0, 60),
+}
+POLL_BUS_BUDGET = 0.6  # Max fraction of the bus time for the polls, limits the adaptive poll rate
+
+# Zero export: closed loop control of the grid exchange with the battery power, via the dispatch registers.
+# The meter is polled every period, a PI controller calculates the battery power
+ZERO_EXPORT_DEVICE        = None          # Device name (see DEVICES), None = off
+ZERO_EXPORT_PERIOD        = 1.0           # [sec] Meter poll and control period
+ZERO_EXPORT_TARGET        = 0             # [W] Grid exchange target, >0 import from the grid
+ZERO_EXPORT_GRID_SIGN     = 1             # 1: Pactive > 0 is import from the grid, -1 when the meter measures the other way around
+ZERO_EXPORT_KP            = 0.5
+ZERO_EXPORT_KI            = 0.3           # [1/sec]
+ZERO_EXPORT_POWER_LIMITS  = (-3000, 3000)  # [W] Battery power: <0 charge, >0 discharge
+ZERO_EXPORT_SOC_RANGE     = (10, 100)     # [%] Not discharged below, not charged above
+ZERO_EXPORT_DEADBAND      = 25            # [W] Min change of the battery power to write it again
+ZERO_EXPORT_METER_TIMEOUT = 10            # [sec] Without meter data the dispatch is stopped
+
+# Max throughput mode: the blocks are polled back-to-back, as fast as the bus allows ('Block' or 'Block/volatility')
+MAX_THROUGHPUT_POLL = ()  # e.g. ('Meter/fast', 'Battery/fast'), () = off
+MAX_THROUGHPUT_UTILISATION = 0.8  # Only polled while the bus utilisation is below this fraction
+MAX_THROUGHPUT_INTERVAL_MIN = 0.3  # [sec] Min time between the requests to a device (Storion T10: instruction interval > 300ms)
+BUS_USAGE_WINDOW = 10  # [sec] Bus utilisation is measured over the last window
+
+READ_PLAN_MAX_GAP = 20  # [registers] Max not used registers read to save a request (request+turnaround ~ 20 registers at 9600 baud)
 
-SEND_INVERTER_MSG_TIMER      = 25   #2.5sec  [100ms]
-SEND_METER_MSG_TIMER         = 9000 #15min   [100ms]
-SEND_BATTERY_MSG_TIMER       = 3000 #5min    [100ms]
-SEND_INVERTER_TEMP_MSG_TIMER = 3000 #5min    [100ms]
+SCHEDULE_INVERTER_TEMP = (300, 10, 1.0)
+SCHEDULE_METRICS       = (300, 20, 5.0)
@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+
+# Local stand-in for the Modbus TCP server of the Storion T10, to test the
+# Modbus TCP transport of alpha-ess-modbus_mqtt without the real hardware.
+#
+# Usage: storion_tcp_simulator.py [port] [response delay in ms]
+# Then add the bus and a device on it in settings.py:
+#   BUSES = {'sim': ('tcp', ('127.0.0.1', port))}
+#   DEVICES = [('Storion', 'sim', 0x55, 'storion-t10', 'huis/AlphaEss')]
+
+import sys
+import time
+import struct
+import socketserver
+import threading
+
+MBAP_HEADER = struct.Struct('>HHHB')
+DEFAULT_TCP_PORT = 5020
+UNIT_ID = 0x55
+
+# Register blocks which can be read, like the Storion T10: (start, count)
+VALID_BLOCKS = ((0x0000, 0x1A), (0x0100, 0x31), (0x0400, 0x32), (0x0700, 0x31))
+
+registers = {}
+registersLock = threading.Lock()
+responseDelay = 0.0
+
+
+def validAddress(start, count):
+    for blockStart, blockCount in VALID_BLOCKS:
+        if (start >= blockStart) and (start + count <= blockStart + blockCount):
+            return True
+    return False
+
+
+def readRegister(address):
+    # Not written registers return a value derived from the address, changing slowly in time
+    return registers.get(address, (address + int(time.time() / 10)) & 0x7FFF)
+
+
+def handleRequest(unitId, pdu):
+    # Returns the response PDU
+    function = pdu[0]
+    if unitId != UNIT_ID:
+        return None
+    if function == 0x03:
+        start, count = struct.unpack_from('>HH', pdu, 1)
+        if (count < 1) or (count > 125) or not validAddress(start, count):
+            return bytes([function | 0x80, 0x02])
+        with registersLock:
+            values = [readRegister(start + i) for i in range(count)]
+        return bytes([function, 2 * count]) + struct.pack('>%dH' % count, *values)
+    if function == 0x06:
+        address, value = struct.unpack_from('>HH', pdu, 1)
+        if not validAddress(address, 1):
+            return bytes([function | 0x80, 0x02])
+        with registersLock:
+            registers[address] = value
+        return bytes(pdu[:5])
+    if function == 0x10:
+        start, count = struct.unpack_from('>HH', pdu, 1)
+        if not validAddress(start, count):
+            return bytes([function | 0x80, 0x02])
+        values = struct.unpack_from('>%dH' % count, pdu, 6)
+        with registersLock:
+            for i, value in enumerate(values):
+                registers[start + i] = value
+        return bytes(pdu[:5])
+    return bytes([function | 0x80, 0x01])
+
+
+class ModbusTcpHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        print("Client connected: %s:%d" % self.client_address)
+        buffer = bytearray()
+        while True:
+            data = self.request.recv(4096)
+            if not data:
+                break
+            buffer += data
+            # Pipelined requests are answered one by one, in order
+            while len(buffer) >= MBAP_HEADER.size:
+                transactionId, protocolId, length, unitId = MBAP_HEADER.unpack_from(buffer)
+                if len(buffer) < 6 + length:
+                    break
+                pdu = bytes(buffer[7:6 + length])
+                del buffer[:6 + length]
+
+                response = handleRequest(unitId, pdu)
+                if response is None:
+                    continue
+                if responseDelay > 0:
+                    time.sleep(responseDelay)
+                self.request.sendall(MBAP_HEADER.pack(transactionId, protocolId, len(response) + 1, unitId) + response)
+        print("Client disconnected: %s:%d" % self.client_address)
+
+
+class ModbusTcpServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def startServer(port=0, delay=0.0):
+    # Start the server in a thread, returns the server (server.server_address is the used address)
+    global responseDelay
+
+    responseDelay = delay
+    server = ModbusTcpServer(('127.0.0.1', port), ModbusTcpHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    tcpPort = DEFAULT_TCP_PORT
+    delayMs = 20
+    if len(sys.argv) > 1:
+        tcpPort = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        delayMs = int(sys.argv[2])
+
+    print("Storion T10 Modbus TCP simulator on port %d, response delay %d ms" % (tcpPort, delayMs))
+    simServer = ModbusTcpServer(('127.0.0.1', tcpPort), ModbusTcpHandler)
+    responseDelay = delayMs / 1000.0
+    try:
+        simServer.serve_forever()
+    except KeyboardInterrupt:
+        print("Program aborted by Ctrl-C")
+    finally:
+        simServer.server_close()
@@ -0,0 +1,150 @@
+import time
+
+
+class PiController(object):
+    """PI controller with anti-windup: the integral is clamped to the output
+    limits, and it is frozen while the output is held at a limit.
+    """
+
+    def __init__(self, kp, ki, minOutput, maxOutput):
+        self.kp = kp
+        self.ki = ki
+        self.minOutput = minOutput
+        self.maxOutput = maxOutput
+        self.integral = 0.0
+
+    def update(self, error, dt, minOutput=None, maxOutput=None):
+        # minOutput/maxOutput: tighter limits for this update (like an empty battery)
+        if minOutput is None:
+            minOutput = self.minOutput
+        if maxOutput is None:
+            maxOutput = self.maxOutput
+        integral = min(max(self.integral + self.ki * error * dt, self.minOutput), self.maxOutput)
+        output = self.kp * error + integral
+        if output > maxOutput:
+            output = maxOutput
+        elif output < minOutput:
+            output = minOutput
+        else:
+            self.integral = integral
+        return output
+
+    def reset(self):
+        self.integral = 0.0
+
+
+class ZeroExportController(object):
+    """Closed loop control of the grid exchange, inside the service: the fast
+    meter poll calls update() with the meter data, the battery power is
+    written via the dispatch registers (see controlWriter.py). A positive
+    dispatch power discharges the battery.
+
+    The battery isn't discharged below socRange[0] or charged above
+    socRange[1]. Without meter data for meterTimeout seconds the dispatch
+    is stopped, the Storion then works in its own mode again.
+
+    Setpoints only count as written when the ack of the control writer
+    confirms them. After a failed write all setpoints are written again
+    (a failed stop is retried on the next meter poll).
+    """
+
+    def __init__(self, device, writer, target, gridSign, kp, ki, powerLimits, socRange, deadband, meterTimeout):
+        self.device = device
+        self.writer = writer
+        self.target = target
+        self.gridSign = gridSign
+        self.pi = PiController(kp, ki, *powerLimits)
+        self.socRange = socRange
+        self.deadband = deadband
+        self.meterTimeout = meterTimeout
+        self.lastUpdateTime = None
+        self.written = {}  # Dispatch setpoints confirmed by the control writer
+        self.queued = {}  # Dispatch setpoints passed to the control writer, not confirmed yet
+        self.setpoint = 0
+        self.updates = 0
+        self.stops = 0
+        writer.ackListeners.append(self.writeDone)
+
+    def lastSetpoint(self, name):
+        # Queued or written, None when it has to be written (again)
+        return self.queued.get(name, self.written.get(name))
+
+    def update(self, meterData, now=None):
+        # Called with the data of the meter block, after each meter poll
+        if now is None:
+            now = time.monotonic()
+        gridPower = meterData.get('Pactive')
+        if gridPower is None:
+            return
+        if (self.lastUpdateTime is None) or ((now - self.lastUpdateTime) > self.meterTimeout):
+            # First update, or after the dispatch is stopped
+            dt = 0.0
+        else:
+            dt = now - self.lastUpdateTime
+        self.lastUpdateTime = now
+        self.updates += 1
+
+        # Positive error: more import from the grid than the target, discharge more
+        error = self.gridSign * gridPower - self.target
+        minPower, maxPower = None, None
+        soc = self.device.lastData.get('Battery', {}).get('SOC')
+        if soc is not None:
+            if soc <= self.socRange[0]:
+                maxPower = 0  # Empty: only charge
+            elif soc >= self.socRange[1]:
+                minPower = 0  # Full: only discharge
+        self.setpoint = round(self.pi.update(error, dt, minPower, maxPower))
+
+        # Discharge until the min SOC, charge until the max SOC
+        socLimit = self.socRange[0] if self.setpoint >= 0 else self.socRange[1]
+        setpoints = {'Dispatch_start': 1, 'Dispatch_mode': 2, 'Dispatch_SOC': socLimit}
+        setpoints = {name: value for name, value in setpoints.items() if self.lastSetpoint(name) != value}
+        lastPower = self.lastSetpoint('Dispatch_power')
+        if (lastPower is None) or (abs(self.setpoint - lastPower) >= self.deadband) or setpoints:
+            setpoints['Dispatch_power'] = self.setpoint
+        if setpoints:
+            self.write(setpoints, now)
+
+    def write(self, setpoints, now):
+        try:
+            self.writer.setpoints(setpoints, now)
+            self.queued.update(setpoints)
+        except ValueError as arg:
+            print("Zero export %s: %s" % (self.device.name, str(arg)))
+
+    def writeDone(self, ack):
+        # Ack of the control writer, can also hold setpoints received via MQTT
+        setpoints = ack.get('setpoints', {})
+        if ack.get('confirmed'):
+            self.written.update(setpoints)
+            for name in setpoints:
+                if self.queued.get(name) == setpoints[name]:
+                    del self.queued[name]
+        else:
+            # Unknown what the Storion has now: write all the setpoints again
+            self.written = {}
+            self.queued = {}
+
+    def checkMeterData(self, now):
+        # Called on every meter poll: stop the dispatch when the meter data is missing
+        if (self.lastUpdateTime is not None) and ((now - self.lastUpdateTime) > self.meterTimeout) and (self.lastSetpoint('Dispatch_start') != 0):
+            print("Zero export %s: no meter data for %g sec, dispatch stopped" % (self.device.name, now - self.lastUpdateTime))
+            self.stop(now)
+
+    def stop(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        self.stops += 1
+        self.pi.reset()
+        # Write all the setpoints again at the next start
+        self.written = {}
+        self.queued = {}
+        self.write({'Dispatch_start': 0}, now)
+
+    def getStats(self):
+        return {
+            'setpoint': self.setpoint,
+            'integral': round(self.pi.integral),
+            'updates': self.updates,
+            'stops': self.stops,
+        }